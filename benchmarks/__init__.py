@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/15 10:02
+# @Author  : zhangbc0315@outlook.com
+# @File    : __init__.py.py
+# @Software: PyCharm
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/15 10:05
+# @Author  : zhangbc0315@outlook.com
+# @File    : pdf_utils_benchmark.py
+# @Software: PyCharm
+
+import os
+import json
+import time
+
+from utils.pdf_utils import PDFUtils
+
+
+class PDFUtilsBenchmark:
+    """ 比较 PDFUtils.parse_paragraph 与旧的逐字符 replace 实现的速度, 并检查输出一致
+
+    输入为 pdfminer 输出的、未经 parse_paragraph 处理的原始段落: 给出 pdf 时从 pdf 中解析,
+    否则使用 data/raw_paragraphs.json 中保存的样例
+    """
+
+    SAMPLE_FP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'raw_paragraphs.json')
+
+    def __init__(self, pdf_fps: [str] = None, num_copies: int = 100):
+        """
+
+        :param pdf_fps: pdf 文件, None 时使用样例
+        :param num_copies: 样例段落的重复次数, 使计时足够长
+        """
+        if pdf_fps is not None:
+            self._paras = [para for pdf_fp in pdf_fps for _, _, para in PDFUtils.iter_raw_paragraphs(pdf_fp)]
+        else:
+            with open(self.SAMPLE_FP, 'r', encoding='utf-8')as f:
+                self._paras = json.load(f) * num_copies
+
+    @classmethod
+    def legacy_clean_text(cls, text: str):
+        for c in text:
+            if ord(c) >= 127 or ord(c) <= 31:
+                text = text.replace(c, ' ')
+        return text
+
+    @classmethod
+    def legacy_parse_paragraph(cls, text: str):
+        text = text.replace('ﬂ', 'fi')
+        text = text.replace('–', '-')
+        text = text.replace('∗', '*')
+        text = text.replace('’', "'")
+        text = text.replace('\x01', 'SOH')
+        lines = text.split('\n')
+        cleaned_lines = []
+        for line in lines:
+            if line.endswith('-'):
+                cleaned_lines.append(line)
+            else:
+                cleaned_lines.append(line + ' ')
+        text = ''.join(cleaned_lines)
+        return cls.legacy_clean_text(text)
+
+    @classmethod
+    def _time(cls, func, paras: [str], repeat: int):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for para in paras:
+                func(para)
+            cost = time.perf_counter() - start
+            best = cost if best is None else min(best, cost)
+        return best
+
+    def run(self, repeat: int = 3):
+        num_diff = sum(1 for para in self._paras
+                       if PDFUtils.parse_paragraph(para) != self.legacy_parse_paragraph(para))
+        legacy_cost = self._time(self.legacy_parse_paragraph, self._paras, repeat)
+        cost = self._time(PDFUtils.parse_paragraph, self._paras, repeat)
+        num_chars = sum(len(para) for para in self._paras)
+        print(f"paragraphs: {len(self._paras)}, chars: {num_chars}, different outputs: {num_diff}")
+        print(f"legacy: {legacy_cost:.3f}s, normalizer: {cost:.3f}s, speedup: {legacy_cost / max(cost, 1e-9):.1f}x")
+        return legacy_cost, cost, num_diff
+
+
+if __name__ == "__main__":
+    PDFUtilsBenchmark().run()
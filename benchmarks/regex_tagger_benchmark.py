@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/20 17:12
+# @Author  : zhangbc0315@outlook.com
+# @File    : regex_tagger_benchmark.py
+# @Software: PyCharm
+
+import re
+import time
+
+import pandas as pd
+from cuspy import ConfigUtils
+
+from data_extractor.nltk_parser import NLTKParser
+from data_extractor.regex_tagger import RegexTagger
+
+
+class RegexTaggerBenchmark:
+    """ 比较 RegexTagger 与旧的逐个 re.match 实现的速度, 并检查输出一致
+
+    token 为 texts.tsv 中文本按空白切分的结果
+    """
+
+    def __init__(self, config, regex_tag_fps: [str], max_num: int = 10000):
+        texts_df = pd.read_csv(config.texts_fp, sep='\t', encoding='utf-8', usecols=['text'], nrows=max_num)
+        self._tokens = [token for text in texts_df['text'] if isinstance(text, str) for token in text.split()]
+        self._tag_to_regex = NLTKParser._load_map_from_fps(regex_tag_fps)
+
+    def legacy_match(self, text: str):
+        res = None
+        for tag, r in self._tag_to_regex.items():
+            if re.match(r, text):
+                res = tag
+        return res
+
+    @classmethod
+    def _time(cls, func, tokens: [str], repeat: int):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for token in tokens:
+                func(token)
+            cost = time.perf_counter() - start
+            best = cost if best is None else min(best, cost)
+        return best
+
+    def run(self, repeat: int = 3):
+        tagger = RegexTagger(self._tag_to_regex, memo_size=0)
+        num_diff = sum(1 for token in self._tokens if tagger.match(token) != self.legacy_match(token))
+        legacy_cost = self._time(self.legacy_match, self._tokens, repeat)
+        combined_cost = self._time(RegexTagger(self._tag_to_regex, memo_size=0).match, self._tokens, repeat)
+        memo_cost = self._time(RegexTagger(self._tag_to_regex).match, self._tokens, 1)
+        print(f"patterns: {len(self._tag_to_regex)}, tokens: {len(self._tokens)}, "
+              f"unique tokens: {len(set(self._tokens))}, different outputs: {num_diff}")
+        print(f"legacy: {legacy_cost:.3f}s, combined: {combined_cost:.3f}s, combined with memo: {memo_cost:.3f}s, "
+              f"speedup: {legacy_cost / max(combined_cost, 1e-9):.1f}x / {legacy_cost / max(memo_cost, 1e-9):.1f}x")
+        return legacy_cost, combined_cost, memo_cost, num_diff
+
+
+if __name__ == "__main__":
+    conf = ConfigUtils.load_config('./config.json')
+    RegexTaggerBenchmark(conf.proj_config, [conf.comm_config.regex_tag_fp]).run()
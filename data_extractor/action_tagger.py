@@ -4,9 +4,10 @@
 # @Author  : zhangbc0315@outlook.com
 # @File    : action_tagger.py
 # @Software: PyCharm
+import os
 import json
-from typing import Iterator
-from datetime import datetime
+import time
+import multiprocessing
 
 import numpy as np
 import nltk
@@ -17,8 +18,12 @@ from cuspy import ConfigUtils
 from fastode import FastXML
 from synexlass.predictor import Predictor
 
-from property_extractor.word_vec_utils import WordVecUtils
-from utils.math_utils import MathUtils
+from utils.lemma_cache import LemmaCache
+from utils.record_batch import RecordBatch
+from utils.stage_manifest import StageManifest
+from utils.tid_index import TidIndex
+from utils.tsv_utils import TSVUtils
+from utils.vector_index import VectorIndex
 
 nltk.download('omw-1.4')
 nltk.download('wordnet')
@@ -26,6 +31,7 @@ nltk.download('wordnet')
 
 class ActionTagger:
 
+    MERGE_JOIN_MIN_RATIO = 0.25
     wrong_vbs = []
     wrong_tokens = ['be', 'have']
     KNOWN_ACTS = ['VB-USE', 'VB-CHANGE', 'VB-SUBMERGE', 'VB-SUBJECT',
@@ -53,10 +59,13 @@ class ActionTagger:
                   'VB-YIELD']                                                             # Yield
 
     def __init__(self, config):
-        self._text_df = pd.read_csv(config.texts_fp, sep='\t', encoding='utf-8')
-        self._tagged_text_df = pd.read_csv(config.texts_tagged_fp, sep='\t', encoding='utf-8')
+        self._texts_fp = config.texts_fp
+        self._texts_tagged_fp = config.texts_tagged_fp
+        self._tagged_text_index = None
+        self._syn_text_labels_fp = config.syn_text_labels_fp
         self._vb_count_fp = config.action_vb_count_fp
-        self._wnl = WordNetLemmatizer()
+        self._lemma_cache_fp = config.lemma_cache_fp
+        self._wnl = LemmaCache(WordNetLemmatizer().lemmatize, self._lemma_cache_fp)
         self._predictor = Predictor()
 
         self._known_action_fp = config.known_action_fp
@@ -64,7 +73,8 @@ class ActionTagger:
         self._unknown_verb_stem_count_fp = config.unknown_verb_stem_count_fp
         self._unknown_verb_score_fp = config.unknown_verb_score_fp
 
-        self._word_vec_utils = WordVecUtils(config)
+        self._words_vec_fp = config.words_vec_fp
+        self._vector_index = None
 
     def get_vbs(self, xml):
         tagged_tokens, _ = FastXML.get_token_tag_pairs_and_attrs(xml, [], [])
@@ -75,48 +85,148 @@ class ActionTagger:
                     yield token
 
     def get_action_and_vbs(self, xml):
+        return self._iter_action_and_vbs(xml, self._wnl)
+
+    @classmethod
+    def _iter_action_and_vbs(cls, xml, wnl: LemmaCache):
         tagged_tokens, _ = FastXML.get_token_tag_pairs_and_attrs(xml, [], [])
         for tag, token in tagged_tokens:
-            if tag in self.KNOWN_ACTS:
+            if tag in cls.KNOWN_ACTS:
                 yield token, tag, True
-            elif tag.startswith('VB') and tag not in self.wrong_vbs:
-                stem = self._wnl.lemmatize(token, 'v')
-                if stem not in self.wrong_tokens:
+            elif tag.startswith('VB') and tag not in cls.wrong_vbs:
+                stem = wnl.lemmatize(token, 'v')
+                if stem not in cls.wrong_tokens:
                     yield token, stem.lower(), False
 
+    def _get_tagged_text_index(self) -> TidIndex:
+        if self._tagged_text_index is None:
+            self._tagged_text_index = TidIndex.load(self._texts_tagged_fp)
+        return self._tagged_text_index
+
+    def _get_vector_index(self) -> VectorIndex:
+        if self._vector_index is None:
+            self._vector_index = VectorIndex.load_or_build(self._words_vec_fp)
+        return self._vector_index
+
     def get_tagged_text_by_tid(self, tid: int):
-        query_df = self._tagged_text_df.query(f"tid=={tid}")
-        if len(query_df) == 0:
+        """ 通过 texts_tagged.tsv 的旁路索引定位行, 只读取这一行
+
+        """
+        row = self._get_tagged_text_index().get_row(tid)
+        if row is None or len(row.get('xml', '')) == 0:
             return None
-        query_df = query_df.reset_index()
-        return query_df['xml'][0]
+        return row['xml']
+
+    def _iter_tagged_texts(self, tids: [int]):
+        """ 按 tids 的顺序取 xml
+
+        tids 和 texts_tagged.tsv 都按 tid 排序且 tids 较多时, 顺序读取 texts_tagged.tsv 归并, 否则按 tid 随机读取
+        :return: 迭代 (tid, xml), 没有 xml 时为 None
+        """
+        tagged_index = self._get_tagged_text_index()
+        is_sorted = all(tids[i] <= tids[i + 1] for i in range(len(tids) - 1))
+        if not (is_sorted and tagged_index.is_sorted()
+                and len(tids) >= self.MERGE_JOIN_MIN_RATIO * len(tagged_index)):
+            for tid in tids:
+                yield tid, self.get_tagged_text_by_tid(tid)
+            return
+        tagged_rows = TSVUtils.iter_rows(self._texts_tagged_fp, ['tid', 'xml'])
+        tagged_row = next(tagged_rows, None)
+        for tid in tids:
+            while tagged_row is not None and tagged_row.tid < tid:
+                tagged_row = next(tagged_rows, None)
+            if tagged_row is not None and tagged_row.tid == tid and not pd.isna(tagged_row.xml):
+                yield tid, tagged_row.xml
+            else:
+                yield tid, None
+
+    # region ===== synthesis text classification =====
+    def _predict_batch(self, texts: [str]) -> [int]:
+        """ Predictor 有批量接口 predict_texts 时使用批量接口
+
+        """
+        predict_texts = getattr(self._predictor, 'predict_texts', None)
+        if predict_texts is not None:
+            return list(predict_texts(texts))
+        return [self._predictor.predict_text(text) for text in texts]
+
+    @classmethod
+    def _is_budget_exhausted(cls, start_time: float, num_items: int, max_seconds: float, max_items: int):
+        if max_seconds is not None and time.perf_counter() - start_time >= max_seconds:
+            return True
+        if max_items is not None and num_items >= max_items:
+            return True
+        return False
+
+    def classify_syn_texts(self, batch_size: int = 64, max_seconds: float = None, max_items: int = None,
+                           chunksize: int = 10000) -> bool:
+        """ 分批判断 texts.tsv 中的文本是否为合成文本, 结果按 tid 写入 syn_text_labels.tsv
+
+        每批判断完成后提交进度, 重新运行时跳过已判断的文本; texts.tsv 只被追加时只判断新增的文本
+        :param batch_size: 每次交给 Predictor 的文本数
+        :param max_seconds: 本次运行的时间预算, 用完后在当前批次结束时停止
+        :param max_items: 本次运行最多判断的文本数
+        :return: 是否已判断所有文本
+        """
+        inputs = {'texts': StageManifest.input_version(self._texts_fp)}
+        manifest = StageManifest([self._syn_text_labels_fp])
+        if not manifest.resume(inputs):
+            manifest.reset(inputs)
+        labels_batch = RecordBatch(self._syn_text_labels_fp, ['tid', 'label'], mode='a', auto_flush=False)
+        num_rows = manifest.state.get('num_input_rows', 0)
+        start_time = time.perf_counter()
+        num_items = 0
+        finished = True
+        tids, texts = [], []
+        with tqdm(initial=num_rows)as pbar:
+            pbar.set_description("classify synthesis texts")
+            for row in TSVUtils.iter_rows(self._texts_fp, ['tid', 'text_type', 'text'],
+                                          chunksize=chunksize, skip_rows=num_rows):
+                pbar.update(1)
+                num_rows += 1
+                if row.text_type != 'TITLE' and not pd.isna(row.text):
+                    tids.append(row.tid)
+                    texts.append(row.text)
+                if len(texts) < batch_size:
+                    continue
+                labels_batch.extend({'tid': tids, 'label': self._predict_batch(texts)})
+                labels_batch.flush()
+                manifest.commit(num_input_rows=num_rows)
+                num_items += len(texts)
+                tids, texts = [], []
+                if self._is_budget_exhausted(start_time, num_items, max_seconds, max_items):
+                    finished = False
+                    pbar.set_postfix_str(f"budget is reached: {num_items} texts")
+                    break
+        labels_batch.extend({'tid': tids, 'label': self._predict_batch(texts)})
+        labels_batch.flush()
+        manifest.commit(num_input_rows=num_rows)
+        return finished
+
+    def _load_syn_tids(self) -> [int]:
+        if not os.path.exists(self._syn_text_labels_fp):
+            return []
+        syn_tids = []
+        for labels_df in TSVUtils.iter_chunks(self._syn_text_labels_fp, ['tid', 'label'], chunksize=100000):
+            syn_tids.extend(labels_df.loc[labels_df['label'] != 0, 'tid'].tolist())
+        return syn_tids
+    # endregion
 
     def get_tagged_syn_text(self):
-        """ 获得解析过的合成文本
+        """ 获得解析过的合成文本, 只包含已被 classify_syn_texts 判断为合成文本的文本
 
         :return:
         """
+        syn_tids = self._load_syn_tids()
         num_syn = 0
-        with tqdm(total=len(self._text_df))as pbar:
+        with tqdm(total=len(syn_tids))as pbar:
             pbar.set_description("get tagged synthesis texts")
-            for n, row in self._text_df.iterrows():
-                # if n > 1000:
-                #     break
+            for tid, tagged_text in self._iter_tagged_texts(syn_tids):
                 pbar.update(1)
-                now_h = datetime.now().time().hour
-                if now_h >= 14 or now_h == 2:
-                    pbar.set_postfix_str(f"time is reach: {now_h}")
-                    break
-                pbar.set_postfix_str(f"num syn text: {num_syn}")
-                if row['text_type'] == 'TITLE':
-                    continue
-                if self._predictor.predict_text(row['text']) == 0:
-                    continue
-                tid = row['tid']
-                tagged_text = self.get_tagged_text_by_tid(tid)
                 if tagged_text is None:
                     continue
                 num_syn += 1
+                pbar.set_postfix_str(f"num syn text: {num_syn}")
                 yield tagged_text, tid
     # endregion
 
@@ -138,38 +248,110 @@ class ActionTagger:
     #     vb_count_df = vb_count_df.sort_values(by='count', axis=0, ascending=False)
     #     vb_count_df.to_csv(self._vb_count_fp, sep='\t', encoding='utf-8', index=False)
 
-    def process(self):
+    # region ===== count verbs =====
+    _worker_wnl = None
+
+    @classmethod
+    def _init_count_worker(cls, lemma_cache_fp: str):
+        """ 每个工作进程加载一份 lemma 缓存, 工作进程中不保存
+
+        """
+        cls._worker_wnl = LemmaCache(WordNetLemmatizer().lemmatize, lemma_cache_fp)
+
+    @classmethod
+    def _count_batch_in_worker(cls, xml_strs: [str]) -> ({}, {}, {}):
+        return cls._count_batch(xml_strs, cls._worker_wnl)
+
+    @classmethod
+    def _count_batch(cls, xml_strs: [str], wnl: LemmaCache) -> ({}, {}, {}):
+        """ map: 统计一批文本中的动词
+
+        :return: (known_vbs, unknown_verbs, unknown_verb_stem_count), 前两个以 dict 的键作为保持插入顺序的集合
+        """
         known_vbs = {}
         unknown_verbs = {}
         unknown_verb_stem_count = {}
-        for xml_str, _ in self.get_tagged_syn_text():
-            if xml_str is None:
-                continue
+        for xml_str in xml_strs:
             try:
                 xml = FastXML.parse_string(xml_str)
             except:
                 continue
-            for vb, vb_type, is_known in self.get_action_and_vbs(xml):
+            for vb, vb_type, is_known in cls._iter_action_and_vbs(xml, wnl):
                 vb = vb.lower()
                 if is_known:
-                    if vb_type not in known_vbs.keys():
-                        known_vbs[vb_type] = [vb]
-                    elif vb not in known_vbs[vb_type]:
-                        known_vbs[vb_type].append(vb)
+                    known_vbs.setdefault(vb_type, {})[vb] = None
                 else:
-                    if vb_type not in unknown_verbs.keys():
-                        unknown_verbs[vb_type] = [vb]
-                    elif vb not in unknown_verbs[vb_type]:
-                        unknown_verbs[vb_type].append(vb)
-                    if vb_type not in unknown_verb_stem_count.keys():
-                        unknown_verb_stem_count[vb_type] = 1
-                    else:
-                        unknown_verb_stem_count[vb_type] += 1
+                    unknown_verbs.setdefault(vb_type, {})[vb] = None
+                    unknown_verb_stem_count[vb_type] = unknown_verb_stem_count.get(vb_type, 0) + 1
+        return known_vbs, unknown_verbs, unknown_verb_stem_count
 
+    @classmethod
+    def _merge_counts(cls, total: ({}, {}, {}), partial: ({}, {}, {})):
+        """ reduce: 按文本顺序合并, 结果与串行统计相同, 与工作进程数无关
+
+        """
+        for total_vbs, partial_vbs in zip(total[:2], partial[:2]):
+            for vb_type, vbs in partial_vbs.items():
+                total_vbs.setdefault(vb_type, {}).update(vbs)
+        for vb_type, count in partial[2].items():
+            total[2][vb_type] = total[2].get(vb_type, 0) + count
+
+    def _iter_syn_xml_batches(self, batch_size: int):
+        xml_strs = []
+        for xml_str, _ in self.get_tagged_syn_text():
+            if xml_str is None:
+                continue
+            xml_strs.append(xml_str)
+            if len(xml_strs) >= batch_size:
+                yield xml_strs
+                xml_strs = []
+        if len(xml_strs) > 0:
+            yield xml_strs
+
+    def count_vbs(self, num_workers: int = 1, batch_size: int = 200) -> ({}, {}, {}):
+        """ 统计所有已判断为合成文本的文本中的动词
+
+        :param num_workers: 大于 1 时用进程池解析 xml 并统计, 按文本顺序合并
+        :param batch_size: 每个任务包含的文本数
+        """
+        total = ({}, {}, {})
+        batches = self._iter_syn_xml_batches(batch_size)
+        pool = None
+        if num_workers > 1:
+            self._wnl.save()
+            pool = multiprocessing.Pool(num_workers, initializer=self._init_count_worker,
+                                        initargs=(self._lemma_cache_fp,))
+            results = pool.imap(self._count_batch_in_worker, batches)
+        else:
+            results = (self._count_batch(xml_strs, self._wnl) for xml_strs in batches)
+        try:
+            for partial in results:
+                self._merge_counts(total, partial)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        return total
+    # endregion
+
+    def process(self, batch_size: int = 64, max_seconds: float = None, max_items: int = None,
+                num_workers: int = 1, count_batch_size: int = 200):
+        """ 先在预算内继续判断合成文本, 再统计所有已判断为合成文本的文本中的动词
+
+        :param batch_size: 见 classify_syn_texts
+        :param max_seconds: 见 classify_syn_texts
+        :param max_items: 见 classify_syn_texts
+        :param num_workers: 见 count_vbs
+        :param count_batch_size: 见 count_vbs 的 batch_size
+        """
+        self.classify_syn_texts(batch_size, max_seconds, max_items)
+        known_vbs, unknown_verbs, unknown_verb_stem_count = self.count_vbs(num_workers, count_batch_size)
+
+        self._wnl.save()
         with open(self._known_action_fp, 'w', encoding='utf-8')as f:
-            json.dump(known_vbs, f)
+            json.dump({key: list(vbs) for key, vbs in known_vbs.items()}, f)
         with open(self._unknown_verbs_fp, 'w', encoding='utf-8')as f:
-            json.dump(unknown_verbs, f)
+            json.dump({key: list(vbs) for key, vbs in unknown_verbs.items()}, f)
 
         sorted_stems = list(sorted(unknown_verb_stem_count.keys(), key=lambda x: unknown_verb_stem_count[x], reverse=True))
         sorted_counts = [unknown_verb_stem_count[x] for x in sorted_stems]
@@ -177,47 +359,96 @@ class ActionTagger:
         verb_stem_count_df.to_csv(self._unknown_verb_stem_count_fp, sep='\t', encoding='utf-8', index=False)
 
     def _words_to_vs(self, key_words):
+        vector_index = self._get_vector_index()
         key_vs = {}
         for key, words in key_words.items():
-            vs = []
-            for w in words:
-                v = self._word_vec_utils.get_vec(w)
-                if v is None:
-                    continue
-                vs.append(v)
-            key_vs[key] = vs
-            # key_vs[key] = [self._word_vec_utils.get_vec(w) for w in words]
+            key_vs[key] = [v for v in vector_index.get_vecs(words) if v is not None]
         return key_vs
 
-    def _get_closed_dis(self, vs1: [], vs2: []):
-        min_cos = 2
-        for v1 in vs1:
-            for v2 in vs2:
-                cos = abs(MathUtils.cos_similarity(v1, v2))
-                if cos < min_cos:
-                    min_cos = cos
-        return min_cos
-
-    def _get_closed_dis_to_word(self, vs1: [], word_vecs: {}):
-        min_cos = 2
-        best_word = None
-        for w, vs2 in word_vecs.items():
-            cos = self._get_closed_dis(vs1, vs2)
-            if cos < min_cos:
-                min_cos = cos
-                best_word = w
-        return best_word, min_cos
-
-    def _query_count(self, df: pd.DataFrame, word: str) -> int:
-        try:
-            query_df = df.query(f"verb_stem == '{word}'")
-        except:
-            return None
-        if len(query_df) == 0:
-            return None
-        return list(query_df.index)[0]
+    @classmethod
+    def _stack_vecs(cls, key_vs: {}) -> (np.ndarray, np.ndarray, np.ndarray):
+        """ 按 key 的顺序堆叠所有向量并归一化, 跳过长度为 0 的向量 (与逐对计算时 cos 为 nan 而被跳过一致)
+
+        :return: (矩阵, 每个 key 的第一个向量所在的行, 有向量的 key 的序号)
+        """
+        vecs = []
+        starts = []
+        key_idxes = []
+        for i, vs in enumerate(key_vs.values()):
+            vs = [v for v in vs if np.linalg.norm(v) > 0]
+            if len(vs) == 0:
+                continue
+            starts.append(len(vecs))
+            key_idxes.append(i)
+            vecs.extend(vs)
+        if len(vecs) == 0:
+            return np.zeros((0, 0)), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        matrix = np.asarray(vecs, dtype=np.float64)
+        matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix, np.asarray(starts, dtype=np.int64), np.asarray(key_idxes, dtype=np.int64)
+
+    @classmethod
+    def _iter_chunks(cls, starts: np.ndarray, num_rows: int, chunk_rows: int):
+        """ 将按 key 分组的行切分为不超过 chunk_rows 行的块, 同一个 key 的行不会被切开
+
+        :return: 迭代 (第一个 key 的序号, 最后一个 key 的序号 + 1)
+        """
+        ends = np.append(starts[1:], num_rows)
+        first = 0
+        for i in range(len(starts)):
+            if i > first and ends[i] - starts[first] > chunk_rows:
+                yield first, i
+                first = i
+        if first < len(starts):
+            yield first, len(starts)
+
+    @classmethod
+    def _get_closed_dis_to_words(cls, unknown_vb_vecs: {}, known_vb_vecs: {}, top_k: int = 1,
+                                 chunk_rows: int = 1024) -> {str: [(str, float)]}:
+        """ 两个词的距离为它们的向量两两之间 |cos| 的最小值, 为每个未知动词找距离最小的已知动作
 
-    def get_new_acts(self):
+        距离相同时取 known_vb_vecs 中靠前的动作; 每次只计算 chunk_rows 个未知动词向量与所有已知动作向量的 |cos|
+        :return: {未知动词: [(已知动作, 距离)]}, 按距离升序, 最多 top_k 个; 没有可比较的向量时为 [(None, 2)]
+        """
+        res = {vb: [(None, 2)] for vb in unknown_vb_vecs.keys()}
+        known_words = list(known_vb_vecs.keys())
+        known_matrix, known_starts, known_idxes = cls._stack_vecs(known_vb_vecs)
+        unknown_words = list(unknown_vb_vecs.keys())
+        unknown_matrix, unknown_starts, unknown_idxes = cls._stack_vecs(unknown_vb_vecs)
+        if len(known_matrix) == 0 or len(unknown_matrix) == 0:
+            return res
+        with tqdm(total=len(unknown_starts))as pbar:
+            for first, last in cls._iter_chunks(unknown_starts, len(unknown_matrix), chunk_rows):
+                pbar.update(last - first)
+                row_start = unknown_starts[first]
+                row_end = unknown_starts[last] if last < len(unknown_starts) else len(unknown_matrix)
+                cos = np.abs(unknown_matrix[row_start: row_end] @ known_matrix.T)
+                cos[np.isnan(cos)] = 2
+                cos = np.minimum.reduceat(cos, known_starts, axis=1)
+                cos = np.minimum.reduceat(cos, unknown_starts[first: last] - row_start, axis=0)
+                for scores, unknown_idx in zip(cos, unknown_idxes[first: last]):
+                    order = np.argsort(scores, kind='stable')[:top_k]
+                    closed = [(known_words[known_idxes[j]], float(scores[j])) for j in order if scores[j] < 2]
+                    if len(closed) > 0:
+                        res[unknown_words[unknown_idx]] = closed
+        return res
+
+    @classmethod
+    def _get_stem_to_index(cls, df: pd.DataFrame) -> {str: int}:
+        """ verb_stem 第一次出现的行号
+
+        """
+        stem_to_index = {}
+        for index, stem in zip(df.index, df['verb_stem']):
+            stem_to_index.setdefault(stem, index)
+        return stem_to_index
+
+    def get_new_acts(self, top_k: int = 1, chunk_rows: int = 1024):
+        """
+
+        :param top_k: 大于 1 时额外输出距离最小的 top_k 个已知动作及其距离 (json 列表)
+        :param chunk_rows: 每次参与矩阵乘法的未知动词向量数, 用于限制内存
+        """
         with open(self._known_action_fp, 'r', encoding='utf-8')as f:
             known_vbs = json.load(f)
         with open(self._unknown_verbs_fp, 'r', encoding='utf-8')as f:
@@ -226,21 +457,28 @@ class ActionTagger:
         unknown_vb_vecs = self._words_to_vs(unknown_vbs)
 
         verb_stem_count_df = pd.read_csv(self._unknown_verb_stem_count_fp, sep='\t', encoding='utf-8')
+        stem_to_index = self._get_stem_to_index(verb_stem_count_df)
+        closed_acts = self._get_closed_dis_to_words(unknown_vb_vecs, known_vb_vecs, top_k, chunk_rows)
         res_data = {'verb_stem': [], 'count': [], 'known_act': [], 'score': []}
+        if top_k > 1:
+            res_data.update({'top_known_acts': [], 'top_scores': []})
         e_num = 0
         with tqdm(total=len(unknown_vb_vecs))as pbar:
-            for unknown_vb, unknown_vecs in unknown_vb_vecs.items():
+            for unknown_vb in unknown_vb_vecs.keys():
                 pbar.update(1)
                 pbar.set_postfix_str(f"error: {e_num}")
-                best_word, min_cos = self._get_closed_dis_to_word(unknown_vecs, known_vb_vecs)
-                count = self._query_count(verb_stem_count_df, unknown_vb)
+                count = stem_to_index.get(unknown_vb)
                 if count is None:
                     e_num += 1
                     continue
+                best_word, min_cos = closed_acts[unknown_vb][0]
                 res_data['verb_stem'].append(unknown_vb)
                 res_data['count'].append(count)
                 res_data['known_act'].append(best_word)
                 res_data['score'].append(min_cos)
+                if top_k > 1:
+                    res_data['top_known_acts'].append(json.dumps([w for w, _ in closed_acts[unknown_vb]]))
+                    res_data['top_scores'].append(json.dumps([c for _, c in closed_acts[unknown_vb]]))
 
         res_df = pd.DataFrame(res_data)
         res_df = res_df.sort_values(by='score', axis=0, ascending=True)
@@ -4,17 +4,78 @@
 # @Author  : zhangbc0315@outlook.com
 # @File    : mol_extractor.py
 # @Software: PyCharm
+import os
 import typing
 
 import pandas as pd
 from tqdm import tqdm
 from cuspy import ConfigUtils
 
+from utils.record_batch import RecordBatch
+from utils.stage_manifest import StageManifest
+from utils.token_store import TokenStore
+
+
+class UniqueMolIndex:
+    """ smiles -> umid 和 name -> umid 的字典, 先按 smiles 查找, 再按 name 查找, 都找不到时分配新的 umid
+
+    同一个 smiles 或 name 对应多个 umid 时, 保留最早的 umid
+    """
+
+    def __init__(self):
+        self._smiles_to_umid = {}
+        self._name_to_umid = {}
+        self.num_mols = 0
+
+    def __len__(self):
+        return self.num_mols
+
+    @classmethod
+    def load(cls, unique_mols_fp: str, chunksize: int = 100000):
+        """ 'NA'、'nan'、'null' 等是合法的分子名, 不能被 pandas 当作缺失值; 只有空字符串表示缺失
+
+        """
+        index = cls()
+        if not os.path.exists(unique_mols_fp):
+            return index
+        for unique_mols_df in pd.read_csv(unique_mols_fp, sep='\t', encoding='utf-8',
+                                          dtype={'name': str, 'smiles': str}, keep_default_na=False,
+                                          chunksize=chunksize):
+            for umid, name, smiles in zip(unique_mols_df['umid'], unique_mols_df['name'], unique_mols_df['smiles']):
+                index._add_new(int(umid), name if len(name) > 0 else None, smiles if len(smiles) > 0 else None)
+        return index
+
+    def _add_new(self, umid: int, name: str, smiles: str):
+        if smiles is not None:
+            self._smiles_to_umid.setdefault(smiles, umid)
+        if name is not None:
+            self._name_to_umid.setdefault(name, umid)
+        self.num_mols = max(self.num_mols, umid + 1)
+
+    def get(self, name: str, smiles: str):
+        if smiles is not None:
+            umid = self._smiles_to_umid.get(smiles)
+            if umid is not None:
+                return umid
+        return self._name_to_umid.get(name)
+
+    def add(self, name: str, smiles: str) -> (int, bool):
+        """
+
+        :return: (umid, 是否为新的分子)
+        """
+        umid = self.get(name, smiles)
+        if umid is not None:
+            return umid, False
+        umid = self.num_mols
+        self._add_new(umid, name, smiles)
+        return umid, True
+
 
 class MolExtractor:
 
     def __init__(self, config):
-        self._tag_token_pairs_fp = config.tag_token_pairs_fp
+        self._tag_token_store_dp = config.tag_token_store_dp
         self._mols_fp = config.mols_fp
         self._unique_mols_fp = config.unique_mols_fp
         self._paper_and_mol_fp = config.paper_and_mol_fp
@@ -26,62 +87,48 @@ class MolExtractor:
                 smiles = smiles if len(smiles) > 0 else None
                 yield tag_token_pair[1], smiles
 
-    @classmethod
-    def _query(cls, df: pd.DataFrame, query_col: str, target_col: str, query_value: str):
-        if any([c in query_value for c in ['\\', "'"]]):
-            for _, row in df.iterrows():
-                if row[query_col] == query_value:
-                    return row[target_col]
-        else:
-            query_df = df.query(f"{query_col}=='{query_value}'")
-            if len(query_df) > 0:
-                query_df = query_df.reset_index()
-                return query_df[target_col][0]
-        return None
-
-    @classmethod
-    def add_to_unique_mol_df(cls, unique_mol_df: pd.DataFrame, name: str, smiles: str):
-        if smiles is not None:
-            umid = cls._query(unique_mol_df, 'smiles', 'umid', smiles)
-            if umid is not None:
-                return unique_mol_df, umid
-            # query_df = unique_mol_df.query(f"smiles=='{smiles}'")
-            # if len(query_df) > 0:
-            #     query_df = query_df.reset_index()
-            #     return unique_mol_df, query_df.umid[0]
-        umid = cls._query(unique_mol_df, 'name', 'umid', name)
-        if umid is not None:
-            return unique_mol_df, umid
-        # query_df = unique_mol_df.query(f"name=='{name}'")
-        # if len(query_df) > 0:
-        #     query_df = query_df.reset_index()
-        #     return unique_mol_df, query_df.umid[0]
+    def process(self, need_smiles: bool):
+        """ 增量处理: TokenStore 只被追加时, 只处理新增的文本, 并沿用已有的 unique_mols
 
-        umid = len(unique_mol_df)
-        unique_mol_df = unique_mol_df.append({'umid': umid, 'name': name, 'smiles': smiles}, ignore_index=True)
-        return unique_mol_df, umid
+        """
+        inputs = {'tag_token_pairs': StageManifest.input_version(TokenStore.version_fp(self._tag_token_store_dp)),
+                  'need_smiles': need_smiles}
+        manifest = StageManifest([self._mols_fp, self._unique_mols_fp, self._paper_and_mol_fp])
+        if not manifest.resume(inputs):
+            manifest.reset(inputs)
+        mols_batch = RecordBatch(self._mols_fp, ['mid', 'umid', 'name', 'smiles'], mode='a', auto_flush=False)
+        unique_mols_batch = RecordBatch(self._unique_mols_fp, ['umid', 'name', 'smiles'], mode='a', auto_flush=False)
+        paper_and_mol_batch = RecordBatch(self._paper_and_mol_fp, ['pid', 'tid', 'name', 'umid'],
+                                          mode='a', auto_flush=False)
+        unique_mols_index = UniqueMolIndex.load(self._unique_mols_fp)
 
-    def process(self, need_smiles: bool):
-        mols_df = pd.DataFrame(columns=['mid', 'umid', 'name', 'smiles'])
-        unique_mols_df = pd.DataFrame(columns=['umid', 'name', 'smiles'])
-        paper_and_mol_df = pd.DataFrame(columns=['pid', 'tid', 'name', 'umid'])
-        tag_token_pairs_df = pd.read_csv(self._tag_token_pairs_fp, sep='\t', encoding='utf-8')
-
-        mid = 0
-        with tqdm(total=len(tag_token_pairs_df))as pbar:
-            for _, row in tag_token_pairs_df.iterrows():
+        num_rows = manifest.state.get('num_input_rows', 0)
+        mid = manifest.state.get('next_mid', 0)
+        token_store = TokenStore(self._tag_token_store_dp)
+        with tqdm(initial=num_rows, total=len(token_store))as pbar:
+            for row in token_store.iter_texts(num_rows):
                 pbar.update(1)
-                for name, smiles in self._get_mol_name_and_smiles(eval(row.tag_token_pairs), eval(row.attr)['smiles']):
+                num_rows += 1
+                for name, smiles in self._get_mol_name_and_smiles(row.tag_token_pairs, row.attr['smiles']):
                     if need_smiles and smiles is None:
                         continue
-                    unique_mols_df, umid = self.add_to_unique_mol_df(unique_mols_df, name, smiles)
-                    mols_df = mols_df.append({'mid': mid, 'umid': umid, 'name': name, 'smiles': smiles}, ignore_index=True)
+                    umid, is_new = unique_mols_index.add(name, smiles)
+                    if is_new:
+                        unique_mols_batch.append({'umid': umid, 'name': name, 'smiles': smiles})
+                    mols_batch.append({'mid': mid, 'umid': umid, 'name': name, 'smiles': smiles})
                     mid += 1
-                    paper_and_mol_df = paper_and_mol_df.append({'pid': row.pid, 'tid': row.tid,
-                                                                'umid': umid, 'name': name}, ignore_index=True)
-        unique_mols_df.to_csv(self._unique_mols_fp, sep='\t', encoding='utf-8', index=False)
-        mols_df.to_csv(self._mols_fp, sep='\t', encoding='utf-8', index=False)
-        paper_and_mol_df.to_csv(self._paper_and_mol_fp, sep='\t', encoding='utf-8', index=False)
+                    paper_and_mol_batch.append({'pid': row.pid, 'tid': row.tid, 'umid': umid, 'name': name})
+                if mols_batch.is_full():
+                    self._flush_batches(manifest, [mols_batch, unique_mols_batch, paper_and_mol_batch],
+                                        num_input_rows=num_rows, next_mid=mid)
+        self._flush_batches(manifest, [mols_batch, unique_mols_batch, paper_and_mol_batch],
+                            num_input_rows=num_rows, next_mid=mid)
+
+    @classmethod
+    def _flush_batches(cls, manifest: StageManifest, batches: [RecordBatch], **state):
+        for batch in batches:
+            batch.flush()
+        manifest.commit(**state)
 
 
 if __name__ == "__main__":
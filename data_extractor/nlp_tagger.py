@@ -5,19 +5,42 @@
 # @File    : nlp_tagger.py
 # @Software: PyCharm
 import os.path
+from concurrent.futures import ThreadPoolExecutor
 
 from tqdm import tqdm
-import pandas as pd
 from cuspy import ConfigUtils
 from fastode import FastLog
 from chem_nlpy import ChemicalTagger
 
+from utils.record_batch import RecordBatch
+from utils.concurrent_utils import ConcurrentUtils
+from utils.stage_manifest import StageManifest
+from utils.tid_index import TidIndex
 from utils.tsv_utils import TSVUtils
 
 
+class ChemicalTaggerClient:
+    """ 用 chem_nlpy.ChemicalTagger 请求 host 上的 ChemicalTagger 服务, 通信协议和连接管理都由 chem_nlpy 实现
+
+    对象只保存 host, 每次调用都是与串行版本相同的 ChemicalTagger.tag_text(text, host=host),
+    因此多个线程共用一个对象时没有共享的可变状态
+    """
+
+    def __init__(self, host: str):
+        self._host = host
+
+    def tag_text(self, text: str) -> str:
+        return ChemicalTagger.tag_text(text, host=self._host)
+
+
 class NLPTagger:
 
-    def __init__(self, config):
+    def __init__(self, config, tagger=None):
+        """
+
+        :param tagger: 有 tag_text(text) -> xml 方法的对象, 默认为 ChemicalTaggerClient(config.chemical_tagger_host)
+        """
+        self._tagger = tagger if tagger is not None else ChemicalTaggerClient(config.chemical_tagger_host)
         self._text_fp = config.texts_fp
         self._text_tagged_fp = config.texts_tagged_fp
         self._logger = FastLog(config.log_fp, 'INFO')
@@ -40,50 +63,75 @@ class NLPTagger:
         return fns
 
     def get_max_tid(self):
-        if os.path.exists(self._text_tagged_fp):
-            _df = pd.read_csv(self._text_tagged_fp, sep='\t', encoding='utf-8')
-            max_tid = _df.tid.max()
-        else:
-            max_tid = -1
-        return max_tid
+        return TidIndex.load(self._text_tagged_fp).max_tid()
 
     def _load_parsed_tids(self):
-        if not os.path.exists(self._text_tagged_fp):
-            return set([])
-        df = pd.read_csv(self._text_tagged_fp, sep='\t', encoding='utf-8')
-        return set(df['tid'].values)
-
-    def process(self):
-        parsed_tids = self._load_parsed_tids()
-        text_df = pd.read_csv(self._text_fp, sep='\t', encoding='utf-8')
-        text_tagged_df = pd.DataFrame(columns=['pid', 'tid', 'text_type', 'year', 'xml'])
-        # tagged_pids = self._load_tagged_fns()
-        with tqdm(total=len(text_df))as pbar:
-            for idx, row in text_df.iterrows():
-                pbar.update(1)
-                if row.pid in parsed_tids:
-                    print(f"tagged: {row.pid}")
-                    continue
-                year = row['year']
-                # self._add_tagged_log(row.pid)
-                # if row.tid <= max_tid:
-                #     continue
-                xml_str = ChemicalTagger.tag_text(row.text, host="http://localhost:8088/nlpj")
-                # xml_str = ChemicalTagger.tag_text(row.text, host="http://114.214.205.122:8088/nlpj")
-                xml_str = xml_str.replace('\n', '')
-                text_tagged_df = text_tagged_df.append({'pid': row.pid,
-                                                        'tid': row.tid,
-                                                        'text_type': row.text_type,
-                                                        'year': year,
-                                                        'xml': xml_str}, ignore_index=True)
-                if len(text_tagged_df) >= 2000:
-                    TSVUtils.df_to_tsv(text_tagged_df, self._text_tagged_fp, mode='a')
-                    text_tagged_df = pd.DataFrame(columns=['pid', 'tid', 'text_type', 'year', 'xml'])
-        if len(text_tagged_df) > 0:
-            TSVUtils.df_to_tsv(text_tagged_df, self._text_tagged_fp, mode='a')
-        # text_tagged_df.to_csv(self._text_tagged_fp, sep='\t', encoding='utf-8', index=False)
+        return TidIndex.load(self._text_tagged_fp).tid_set()
+
+    def _tag_text(self, text: str, max_retries: int, backoff: float) -> str:
+        xml_str = ConcurrentUtils.retry(self._tagger.tag_text, text, max_retries=max_retries, backoff=backoff)
+        return xml_str.replace('\n', '')
+
+    def _iter_text_rows(self, skip_rows: int, chunksize: int):
+        return TSVUtils.iter_rows(self._text_fp, ['pid', 'tid', 'text_type', 'year', 'text'],
+                                  chunksize=chunksize, skip_rows=skip_rows)
+
+    def process(self, chunksize: int = 10000, num_workers: int = 1, max_in_flight: int = None,
+                max_retries: int = 3, backoff: float = 1.0):
+        """ 增量处理: texts.tsv 只被追加时, 只对新增的文本打标签
+
+        :param num_workers: 同时向 ChemicalTagger 服务发送请求的线程数
+        :param max_in_flight: 已发送但还未写入的文本数上限, 默认为 num_workers 的 4 倍
+        :param max_retries: 请求失败后的重试次数, 超过后抛出异常, 重新运行时从上次写入的位置继续
+        :param backoff: 第一次重试前等待的秒数, 之后每次加倍
+        """
+        inputs = {'texts': StageManifest.input_version(self._text_fp)}
+        manifest = StageManifest([self._text_tagged_fp])
+        parsed_tids = set([])
+        if not manifest.exists and os.path.exists(self._text_tagged_fp):
+            # 没有 manifest 的旧输出, 沿用并按 tid 跳过已解析的文本
+            parsed_tids = self._load_parsed_tids()
+            manifest.reset(inputs, keep_outputs=True)
+        elif not manifest.resume(inputs):
+            manifest.reset(inputs)
+        text_tagged_batch = RecordBatch(self._text_tagged_fp, ['pid', 'tid', 'text_type', 'year', 'xml'],
+                                        batch_size=2000, mode='a', auto_flush=False)
+        num_rows = manifest.state.get('num_input_rows', 0)
+
+        def tag_row(row):
+            if row.tid in parsed_tids:
+                return None
+            return self._tag_text(row.text, max_retries, backoff)
+
+        rows = self._iter_text_rows(num_rows, chunksize)
+        executor = None
+        if num_workers > 1:
+            executor = ThreadPoolExecutor(num_workers)
+            results = ConcurrentUtils.ordered_imap(executor, tag_row, rows, max_in_flight or 4 * num_workers)
+        else:
+            results = ((row, tag_row(row)) for row in rows)
+        try:
+            with tqdm(initial=num_rows)as pbar:
+                for row, xml_str in results:
+                    pbar.update(1)
+                    num_rows += 1
+                    if xml_str is None:
+                        continue
+                    text_tagged_batch.append({'pid': row.pid,
+                                              'tid': row.tid,
+                                              'text_type': row.text_type,
+                                              'year': row.year,
+                                              'xml': xml_str})
+                    if text_tagged_batch.is_full():
+                        text_tagged_batch.flush()
+                        manifest.commit(num_input_rows=num_rows)
+            text_tagged_batch.flush()
+            manifest.commit(num_input_rows=num_rows)
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
 
 if __name__ == "__main__":
     nt = NLPTagger(ConfigUtils.load_config('./config.json').proj_config)
-    nt.process()
+    nt.process(num_workers=16)
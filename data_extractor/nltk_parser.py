@@ -6,13 +6,56 @@
 # @Software: PyCharm
 
 import json
-import re
 
 from cuspy import ConfigUtils
 import nltk
 import requests
+from requests.adapters import HTTPAdapter
 from chemdataextractor.doc import Paragraph, Sentence, Token
-import nltk
+
+from data_extractor.regex_tagger import RegexTagger
+
+
+class OscarTagger:
+    """ OSCAR 标注服务的客户端: 复用 keep-alive 连接, 并将多个句子合并为一次请求
+
+    批量接口: POST {host}/tagTokensOscarCustomisedBatch, {"sentences": [tokens, ...]} -> {"tags": [tags, ...]}
+    服务没有批量接口时 (404/405/501), 退回到逐句请求 {host}/tagTokensOscarCustomised
+    """
+
+    def __init__(self, host: str = 'http://127.0.0.1:8089', batch_size: int = 256, pool_size: int = 4):
+        self._url = f"{host}/tagTokensOscarCustomised"
+        self._batch_url = f"{host}/tagTokensOscarCustomisedBatch"
+        self._batch_size = batch_size
+        self._has_batch_route = True
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def tag(self, tokens: []) -> [str]:
+        res = self._session.post(self._url, json={'tokens': tokens})
+        res_json = json.loads(res.text)
+        return res_json['tags']
+
+    def tag_many(self, tokens_list: [[]]) -> [[str]]:
+        tags_list = []
+        for start in range(0, len(tokens_list), self._batch_size):
+            tags_list.extend(self._tag_batch(tokens_list[start: start + self._batch_size]))
+        return tags_list
+
+    def _tag_batch(self, tokens_list: [[]]) -> [[str]]:
+        if self._has_batch_route:
+            res = self._session.post(self._batch_url, json={'sentences': tokens_list})
+            if res.status_code in (404, 405, 501):
+                self._has_batch_route = False
+            else:
+                res.raise_for_status()
+                tags_list = json.loads(res.text)['tags']
+                if len(tags_list) != len(tokens_list):
+                    raise ValueError(f"expect {len(tokens_list)} tag lists from OSCAR, but get {len(tags_list)}")
+                return tags_list
+        return [self.tag(tokens) for tokens in tokens_list]
 
 
 class NLTKParser:
@@ -46,10 +89,12 @@ class NLTKParser:
                "VerbPhrase: {<IN><RB>?<VB-ALL>}\n" \
                "VerbPhrase: {<VerbPhrase><PrepPhrase>}"
 
-    def __init__(self, regex_tag_fps: [str], dict_tag_fps: [str]):
+    def __init__(self, regex_tag_fps: [str], dict_tag_fps: [str], oscar_host: str = 'http://127.0.0.1:8089'):
         self._tag_to_regex = self._load_map_from_fps(regex_tag_fps)
         self._tag_to_str = self._load_map_from_fps(dict_tag_fps)
+        self._regex_tagger = RegexTagger(self._tag_to_regex)
         self._rp = nltk.RegexpParser(self._grammar)
+        self._oscar_tagger = OscarTagger(oscar_host)
 
     # region ===== utils =====
     @classmethod
@@ -66,7 +111,7 @@ class NLTKParser:
             for line in f.readlines():
                 if line.startswith('#') or '---' not in line:
                     continue
-                data = line.split('---')
+                data = line.rstrip('\r\n').split('---')
                 map_data[data[0]] = data[1]
         return map_data
     # endregion
@@ -85,10 +130,8 @@ class NLTKParser:
 
     # region ===== chem tagger =====
     @staticmethod
-    def _chem_oscar_tag(tokens):
-        res = requests.post('http://127.0.0.1:8089/tagTokensOscarCustomised', json={'tokens': tokens})
-        res_json = json.loads(res.text)
-        for i, tag in enumerate(res_json['tags']):
+    def _apply_oscar_tags(tokens, tags: [str]):
+        for i, tag in enumerate(tags):
             if tag == 'OSCAR-CM':
                 if i != 0 and tokens[i-1].get('tag') is not None and tokens[i-1].get('tag') in ['B-CM', 'I-CM']:
                     tokens[i]['tag'] = 'I-CM'
@@ -96,6 +139,9 @@ class NLTKParser:
                     tokens[i]['tag'] = 'B-CM'
         return tokens
 
+    def _chem_oscar_tag(self, tokens):
+        return self._apply_oscar_tags(tokens, self._oscar_tagger.tag(tokens))
+
     @staticmethod
     def _chem_cde_tag(sent, tokens):
         for i, tag in enumerate(sent.ner_tags):
@@ -103,10 +149,9 @@ class NLTKParser:
                 tokens[i]['tag'] = tag
         return tokens
 
-    @classmethod
-    def _chem_tag(cls, sent: Sentence, tokens: []):
-        tokens = cls._chem_cde_tag(sent, tokens)
-        tokens = cls._chem_oscar_tag(tokens)
+    def _chem_tag(self, sent: Sentence, tokens: []):
+        tokens = self._chem_cde_tag(sent, tokens)
+        tokens = self._chem_oscar_tag(tokens)
         return tokens
     # endregion
 
@@ -126,9 +171,9 @@ class NLTKParser:
         for token in tokens:
             if token['tag'] in ['B-CM', 'I-CM']:
                 continue
-            for tag, r in self._tag_to_regex.items():
-                if re.match(r, token['text']):
-                    token['tag'] = tag
+            tag = self._regex_tagger.match(token['text'])
+            if tag is not None:
+                token['tag'] = tag
         return tokens
     # endregion
 
@@ -138,19 +183,56 @@ class NLTKParser:
         return self._rp.parse(token_tags)
     # endregion
 
-    def parse(self, text: str):
-        paragraph = Paragraph(text)
-        for sent in paragraph.sentences:
+    def _tag_sentences(self, sents: [Sentence]) -> [[{}]]:
+        """ 对多个句子打标签, 所有句子的 OSCAR 标注合并为少量批量请求
+
+        """
+        tokens_list = []
+        for sent in sents:
             tokens = self._get_tokens(sent)
             tokens = self._pos_tag(sent, tokens)
-            tokens = self._chem_tag(sent, tokens)
-            tokens = self._regex_tag(tokens)
-            tree = self._syntax_parser(tokens)
-            tree.draw()
-            print(1)
+            tokens = self._chem_cde_tag(sent, tokens)
+            tokens_list.append(tokens)
+        tags_list = self._oscar_tagger.tag_many(tokens_list)
+        return [self._regex_tag(self._apply_oscar_tags(tokens, tags)) for tokens, tags in zip(tokens_list, tags_list)]
+
+    # region ===== serialize =====
+    @classmethod
+    def _tree_to_obj(cls, tree):
+        if isinstance(tree, nltk.Tree):
+            return {'label': tree.label(), 'children': [cls._tree_to_obj(child) for child in tree]}
+        return list(tree)
+
+    @classmethod
+    def tree_to_json(cls, tree: nltk.Tree) -> str:
+        """ 叶子为 [token, tag], 其他节点为 {"label": ..., "children": [...]}
+
+        """
+        return json.dumps(cls._tree_to_obj(tree), ensure_ascii=False)
+    # endregion
+
+    def parse(self, text: str) -> [nltk.Tree]:
+        paragraph = Paragraph(text)
+        return [self._syntax_parser(tokens) for tokens in self._tag_sentences(paragraph.sentences)]
+
+    def parse_many(self, texts: [str]) -> [[str]]:
+        """ 解析多个文本, 所有句子的 OSCAR 标注合并为少量批量请求
+
+        :return: 每个文本中各个句子的语法树 (tree_to_json 的结果)
+        """
+        sents_list = [Paragraph(text).sentences for text in texts]
+        tokens_list = self._tag_sentences([sent for sents in sents_list for sent in sents])
+        trees_list = []
+        i = 0
+        for sents in sents_list:
+            trees_list.append([self.tree_to_json(self._syntax_parser(tokens))
+                               for tokens in tokens_list[i: i + len(sents)]])
+            i += len(sents)
+        return trees_list
 
 
 if __name__ == "__main__":
     s = ""
     conf = ConfigUtils.load_config('../config.json')
-    NLTKParser([conf.comm_config.regex_tag_fp], []).parse(s)
+    for tree in NLTKParser([conf.comm_config.regex_tag_fp], []).parse(s):
+        tree.draw()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/28 10:17
+# @Author  : zhangbc0315@outlook.com
+# @File    : property_value_extractor.py
+# @Software: PyCharm
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from cuspy import ConfigUtils
+
+from utils.record_batch import RecordBatch
+from utils.stage_manifest import StageManifest
+from utils.token_store import TokenStore
+
+
+class TokenAhoCorasick:
+    """ token id 序列上的 Aho-Corasick 自动机, 扫描一遍 token 即可找到所有模式的所有出现位置
+
+    """
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._outs = [[]]
+        self.pattern_lens = []
+
+    def __len__(self):
+        return len(self.pattern_lens)
+
+    def add(self, pattern: [int]) -> int:
+        """
+
+        :return: 模式的序号
+        """
+        state = 0
+        for token in pattern:
+            next_state = self._goto[state].get(token)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][token] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._outs.append([])
+            state = next_state
+        pattern_idx = len(self.pattern_lens)
+        self._outs[state].append(pattern_idx)
+        self.pattern_lens.append(len(pattern))
+        return pattern_idx
+
+    def build(self):
+        """ 按层计算失配链接, 每个状态的输出包含其失配链接上所有状态的输出
+
+        """
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for token, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail != 0 and token not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(token, 0)
+                self._outs[next_state] = self._outs[next_state] + self._outs[self._fail[next_state]]
+                queue.append(next_state)
+
+    def iter_matches(self, tokens: [int]):
+        """
+
+        :return: 迭代 (模式结束的位置 (不包含), 模式的序号)
+        """
+        goto, fail, outs = self._goto, self._fail, self._outs
+        state = 0
+        for i, token in enumerate(tokens):
+            while state != 0 and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            for pattern_idx in outs[state]:
+                yield i + 1, pattern_idx
+
+
+class PropertyValueExtractor:
+    """ 把 filter_units.tsv 中的单位编译为一个 TokenAhoCorasick, 流式读取 token store 一遍,
+    找出 CD 之后紧接着的最长的单位, 得到 (数值, 单位) 形式的性质
+
+    """
+
+    def __init__(self, config):
+        self._tag_token_store_dp = config.tag_token_store_dp
+        self._filter_units_fp = config.filter_units_fp
+        self._properties_fp = config.properties_fp
+
+    def _load_matcher(self, vocab: [str]) -> (TokenAhoCorasick, [str]):
+        """ 单位中的 token 不在 token store 的 vocab 中时, 单位不可能出现, 被跳过
+
+        :return: (自动机, 每个模式对应的单位)
+        """
+        vocab_ids = {s: i for i, s in enumerate(vocab)}
+        unit_df = pd.read_csv(self._filter_units_fp, sep='\t', encoding='utf-8', dtype={'unit': str, 'tag': str},
+                              keep_default_na=False)
+        matcher = TokenAhoCorasick()
+        units = []
+        added = set()
+        for unit in unit_df['unit']:
+            tokens = unit.split(' ')
+            if unit in added or any(token not in vocab_ids for token in tokens):
+                continue
+            added.add(unit)
+            matcher.add([vocab_ids[token] for token in tokens])
+            units.append(unit)
+        matcher.build()
+        return matcher, units
+
+    @classmethod
+    def _match_text(cls, matcher: TokenAhoCorasick, tags: [int], tokens: [int], cd_id: int) -> [(int, int)]:
+        """ 对每个 CD, 取从它之后开始的最长的单位
+
+        :return: [(CD 的位置, 模式的序号)], 按位置排序
+        """
+        best = {}
+        for end, pattern_idx in matcher.iter_matches(tokens):
+            start = end - matcher.pattern_lens[pattern_idx]
+            if start == 0 or tags[start - 1] != cd_id:
+                continue
+            if start not in best.keys() or matcher.pattern_lens[pattern_idx] > matcher.pattern_lens[best[start]]:
+                best[start] = pattern_idx
+        return [(start - 1, best[start]) for start in sorted(best.keys())]
+
+    def process(self):
+        """ 增量处理: TokenStore 只被追加且 filter_units.tsv 不变时, 只处理新增的文本
+
+        sentence_idx 为 CD 之前的 STOP 的个数, token_idx 为 CD 在文本中的位置
+        """
+        inputs = {'tag_token_pairs': StageManifest.input_version(TokenStore.version_fp(self._tag_token_store_dp)),
+                  'filter_units': StageManifest.input_version(self._filter_units_fp)}
+        manifest = StageManifest([self._properties_fp])
+        if not manifest.resume(inputs):
+            manifest.reset(inputs)
+        properties_batch = RecordBatch(self._properties_fp,
+                                       ['pid', 'tid', 'sentence_idx', 'token_idx', 'value', 'unit'],
+                                       batch_size=10000, mode='a', auto_flush=False)
+        token_store = TokenStore(self._tag_token_store_dp)
+        vocab = token_store.vocab
+        matcher, units = self._load_matcher(vocab)
+        vocab_ids = {s: i for i, s in enumerate(vocab)}
+        cd_id = vocab_ids.get('CD')
+        stop_id = vocab_ids.get('STOP')
+
+        num_rows = manifest.state.get('num_input_rows', 0)
+        with tqdm(initial=num_rows, total=len(token_store))as pbar:
+            for i in range(num_rows, len(token_store)):
+                pbar.update(1)
+                num_rows += 1
+                if cd_id is None or len(matcher) == 0:
+                    continue
+                start, end = token_store.token_range(i)
+                tags = token_store.tags[start: end]
+                matches = self._match_text(matcher, tags.tolist(), token_store.tokens[start: end].tolist(), cd_id)
+                if len(matches) == 0:
+                    continue
+                sentence_idxes = np.cumsum(np.asarray(tags) == stop_id) if stop_id is not None else None
+                pid, tid = int(token_store.pids[i]), int(token_store.tids[i])
+                for cd_idx, pattern_idx in matches:
+                    properties_batch.append({'pid': pid,
+                                             'tid': tid,
+                                             'sentence_idx': int(sentence_idxes[cd_idx]) if stop_id is not None else 0,
+                                             'token_idx': cd_idx,
+                                             'value': vocab[int(token_store.tokens[start + cd_idx])],
+                                             'unit': units[pattern_idx]})
+                if properties_batch.is_full():
+                    properties_batch.flush()
+                    manifest.commit(num_input_rows=num_rows)
+        properties_batch.flush()
+        manifest.commit(num_input_rows=num_rows)
+
+
+if __name__ == "__main__":
+    PropertyValueExtractor(ConfigUtils.load_config('./config.json').proj_config).process()
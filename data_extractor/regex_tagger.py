@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/20 16:31
+# @Author  : zhangbc0315@outlook.com
+# @File    : regex_tagger.py
+# @Software: PyCharm
+
+import re
+import functools
+
+
+class RegexTagger:
+    """ 将 {tag: regex} 编译为一个带命名分组的正则
+
+    与依次对每个 (tag, regex) 调用 re.match、后匹配的 tag 覆盖先匹配的 tag 的结果一致:
+    分组按逆序排列, 正则的分支从左到右尝试, 第一个匹配的分支即为原顺序中最后一个匹配的 tag
+    """
+
+    _BACKREF_RE = re.compile(r'\\[1-9]|\(\?P=')
+
+    def __init__(self, tag_to_regex: {str: str}, memo_size: int = 1 << 20):
+        """
+
+        :param tag_to_regex: 有序的 {tag: regex}
+        :param memo_size: 缓存的 token 数, 化学文本中的 token 重复率很高
+        """
+        self._tags = list(tag_to_regex.keys())
+        self._compiled_res = [re.compile(r) for r in tag_to_regex.values()]
+        self._combined_re = self._compile_combined(list(tag_to_regex.values()))
+        self.match = functools.lru_cache(maxsize=memo_size)(self._match)
+
+    @classmethod
+    def _compile_combined(cls, patterns: [str]):
+        """ 含反向引用的正则在合并后分组编号会改变, 此时不合并
+
+        """
+        if any(cls._BACKREF_RE.search(p) for p in patterns):
+            return None
+        parts = [f"(?P<_t{i}>{patterns[i]})" for i in reversed(range(len(patterns)))]
+        try:
+            return re.compile('|'.join(parts))
+        except re.error:
+            return None
+
+    def _match(self, text: str):
+        """
+
+        :return: 匹配的 tag, 都不匹配时为 None
+        """
+        if self._combined_re is not None:
+            m = self._combined_re.match(text)
+            if m is None:
+                return None
+            if m.lastgroup is not None and m.lastgroup.startswith('_t'):
+                return self._tags[int(m.lastgroup[2:])]
+        for tag, compiled_re in zip(reversed(self._tags), reversed(self._compiled_res)):
+            if compiled_re.match(text):
+                return tag
+        return None
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/19 9:48
+# @Author  : zhangbc0315@outlook.com
+# @File    : syntax_tree_extractor.py
+# @Software: PyCharm
+
+import multiprocessing
+
+from tqdm import tqdm
+from cuspy import ConfigUtils
+
+from data_extractor.nltk_parser import NLTKParser
+from utils.record_batch import RecordBatch
+from utils.stage_manifest import StageManifest
+from utils.tsv_utils import TSVUtils
+
+
+class SyntaxTreeExtractor:
+    """ 将 texts.tsv 中每个句子的语法树写入 syntax_trees.tsv, 每个工作进程只创建一次 NLTKParser
+
+    """
+
+    _worker_parser = None
+
+    def __init__(self, config, regex_tag_fps: [str], dict_tag_fps: [str], oscar_host: str = 'http://127.0.0.1:8089'):
+        self._texts_fp = config.texts_fp
+        self._syntax_trees_fp = config.syntax_trees_fp
+        self._parser_args = (list(regex_tag_fps), list(dict_tag_fps), oscar_host)
+
+    @classmethod
+    def _init_worker(cls, regex_tag_fps: [str], dict_tag_fps: [str], oscar_host: str):
+        cls._worker_parser = NLTKParser(regex_tag_fps, dict_tag_fps, oscar_host)
+
+    @classmethod
+    def _parse_batch(cls, batch: ([int], [int], [str])) -> ([int], [int], [[str]], [str], int):
+        """ 在工作进程中运行, 失败信息随结果返回, 由主进程显示在进度条上
+
+        :return: (tids, pids, 每个文本的句法树, 失败信息, 失败的文本数)
+        """
+        tids, pids, texts = batch
+        messages = []
+        num_failed = 0
+        try:
+            trees_list = cls._worker_parser.parse_many(texts)
+        except Exception as e:
+            messages.append(f"batch failed ({e}), parse texts one by one")
+            trees_list = []
+            for tid, text in zip(tids, texts):
+                try:
+                    trees_list.append(cls._worker_parser.parse_many([text])[0])
+                except Exception as e:
+                    messages.append(f"tid: {tid} failed: {e}")
+                    num_failed += 1
+                    trees_list.append([])
+        return tids, pids, trees_list, messages, num_failed
+
+    def _iter_batches(self, skip_rows: int, chunksize: int, batch_size: int):
+        for texts_df in TSVUtils.iter_chunks(self._texts_fp, ['tid', 'pid', 'text'], chunksize=chunksize,
+                                             skip_rows=skip_rows, dtype={'text': str}):
+            texts_df = texts_df.fillna({'text': ''})
+            for start in range(0, len(texts_df), batch_size):
+                batch_df = texts_df.iloc[start: start + batch_size]
+                yield list(batch_df['tid']), list(batch_df['pid']), list(batch_df['text'])
+
+    def process(self, num_workers: int = 1, batch_size: int = 32, chunksize: int = 10000):
+        """ 增量处理: texts.tsv 只被追加时, 只解析新增的文本
+
+        :param num_workers: 工作进程数
+        :param batch_size: 每个任务包含的文本数, 同一任务的句子合并请求 OSCAR
+        """
+        inputs = {'texts': StageManifest.input_version(self._texts_fp)}
+        manifest = StageManifest([self._syntax_trees_fp])
+        if not manifest.resume(inputs):
+            manifest.reset(inputs)
+        trees_batch = RecordBatch(self._syntax_trees_fp, ['tid', 'pid', 'sid', 'tree'],
+                                  batch_size=5000, mode='a', auto_flush=False)
+        num_rows = manifest.state.get('num_input_rows', 0)
+        batches = self._iter_batches(num_rows, chunksize, batch_size)
+        pool = None
+        if num_workers > 1:
+            pool = multiprocessing.Pool(num_workers, initializer=self._init_worker, initargs=self._parser_args)
+            results = pool.imap(self._parse_batch, batches)
+        else:
+            self._init_worker(*self._parser_args)
+            results = map(self._parse_batch, batches)
+        try:
+            e_num = 0
+            with tqdm(initial=num_rows)as pbar:
+                pbar.set_description("syntax tree")
+                for tids, pids, trees_list, messages, num_failed in results:
+                    pbar.update(len(tids))
+                    for message in messages:
+                        pbar.write(message)
+                    if num_failed > 0:
+                        e_num += num_failed
+                        pbar.set_postfix_str(f"error: {e_num}")
+                    num_rows += len(tids)
+                    for tid, pid, trees in zip(tids, pids, trees_list):
+                        for sid, tree in enumerate(trees):
+                            trees_batch.append({'tid': tid, 'pid': pid, 'sid': sid, 'tree': tree})
+                    if trees_batch.is_full():
+                        trees_batch.flush()
+                        manifest.commit(num_input_rows=num_rows)
+            trees_batch.flush()
+            manifest.commit(num_input_rows=num_rows)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+
+if __name__ == "__main__":
+    conf = ConfigUtils.load_config('./config.json')
+    ste = SyntaxTreeExtractor(conf.proj_config, [conf.comm_config.regex_tag_fp], [])
+    ste.process(num_workers=multiprocessing.cpu_count())
@@ -4,54 +4,105 @@
 # @Author  : zhangbc0315@outlook.com
 # @File    : tag_token_extractor.py
 # @Software: PyCharm
-import os.path
+
+import os
+import multiprocessing
 
 from tqdm import tqdm
 import pandas as pd
 from cuspy import ConfigUtils
 from fastode import FastLog, FastXML
 
+from utils.stage_manifest import StageManifest
+from utils.token_store import TokenStore, TokenStoreWriter
 from utils.tsv_utils import TSVUtils
 
 
 class TagTokenExtractor:
 
+    ATTR_NAMES = ['smiles']
+
     def __init__(self, config):
         self._logger = FastLog(config.log_fp, 'INFO').logger
         self._texts_tagged_fp = config.texts_tagged_fp
-        self._tag_token_pairs_fp = config.tag_token_pairs_fp
-
-    def process(self):
-        texts_tagged_df = pd.read_csv(self._texts_tagged_fp, sep='\t', encoding='utf-8')
-        tag_token_pairs_df = pd.DataFrame(columns=['pid', 'tid', 'text_type', 'year', 'tag_token_pairs', 'attr'])
-        if os.path.exists(self._tag_token_pairs_fp):
-            os.remove(self._tag_token_pairs_fp)
-        with tqdm(total=len(texts_tagged_df))as pbar:
-            for _, row in texts_tagged_df.iterrows():
-                pbar.update(1)
-                year = row['year']
-                try:
-                    xml = FastXML.parse_string(row.xml)
-                except Exception as e:
-                    self._logger.warning(f"xml is wrong: \n"
-                                         f"pid:{row.pid}, tid:{row.tid},\n"
-                                         f"xml:{row.xml}")
-                    continue
-                tag_token_pairs, attrs = FastXML.get_token_tag_pairs_and_attrs(xml, ['OSCARCM'], ['smiles'])
-                tag_token_pairs_df = tag_token_pairs_df.append({'pid': row.pid,
-                                                                'tid': row.tid,
-                                                                'text_type': row.text_type,
-                                                                'year': year,
-                                                                'tag_token_pairs': tag_token_pairs,
-                                                                'attr': attrs}, ignore_index=True)
-                if len(tag_token_pairs_df) >= 2000:
-                    TSVUtils.df_to_tsv(tag_token_pairs_df, self._tag_token_pairs_fp, mode='a')
-                    tag_token_pairs_df = pd.DataFrame(columns=['pid', 'tid', 'text_type', 'year', 'tag_token_pairs', 'attr'])
-        # tag_token_pairs_df.to_csv(self._tag_token_pairs_fp, sep='\t', encoding='utf-8', index=False)
-        if len(tag_token_pairs_df) > 0:
-            TSVUtils.df_to_tsv(tag_token_pairs_df, self._tag_token_pairs_fp, mode='a')
+        self._tag_token_store_dp = config.tag_token_store_dp
+
+    @classmethod
+    def _parse_batch(cls, rows: [()]) -> [()]:
+        """ 在工作进程中解析 xml
+
+        :param rows: [(pid, tid, text_type, year, xml)]
+        :return: [{pid, tid, text_type, year, tag_token_pairs, attrs}], xml 错误时为 {pid, tid, wrong_xml}
+        """
+        results = []
+        for pid, tid, text_type, year, xml_str in rows:
+            try:
+                xml = FastXML.parse_string(xml_str)
+            except Exception:
+                results.append({'pid': pid, 'tid': tid, 'wrong_xml': xml_str})
+                continue
+            tag_token_pairs, attrs = FastXML.get_token_tag_pairs_and_attrs(xml, ['OSCARCM'], cls.ATTR_NAMES)
+            results.append({'pid': pid, 'tid': tid, 'text_type': text_type, 'year': year,
+                            'tag_token_pairs': tag_token_pairs, 'attrs': attrs})
+        return results
+
+    def _iter_batches(self, skip_rows: int, chunksize: int, batch_size: int):
+        for texts_tagged_df in TSVUtils.iter_chunks(self._texts_tagged_fp, ['pid', 'tid', 'text_type', 'year', 'xml'],
+                                                    chunksize=chunksize, skip_rows=skip_rows):
+            rows = [(pid, tid, text_type, None if pd.isna(year) else year, xml)
+                    for pid, tid, text_type, year, xml in zip(texts_tagged_df['pid'], texts_tagged_df['tid'],
+                                                              texts_tagged_df['text_type'], texts_tagged_df['year'],
+                                                              texts_tagged_df['xml'])]
+            for start in range(0, len(rows), batch_size):
+                yield rows[start: start + batch_size]
+
+    def process(self, chunksize: int = 10000, num_workers: int = 1, batch_size: int = 500):
+        """ 增量处理: texts_tagged.tsv 只被追加时, 只解析新增的行
+
+        结果写入 TokenStore, 下游通过 TokenStore 读取, 不再 eval tsv 中的字符串
+        :param num_workers: 大于 1 时用进程池解析 xml, 结果仍按 texts_tagged.tsv 的顺序写入
+        :param batch_size: 每个任务包含的行数
+        """
+        inputs = {'texts_tagged': StageManifest.input_version(self._texts_tagged_fp),
+                  'attr_names': self.ATTR_NAMES}
+        if not os.path.exists(self._tag_token_store_dp):
+            os.makedirs(self._tag_token_store_dp)
+        manifest = StageManifest(TokenStore.get_fps(self._tag_token_store_dp, self.ATTR_NAMES))
+        if not manifest.resume(inputs):
+            manifest.reset(inputs)
+        tag_token_pairs_batch = TokenStoreWriter(self._tag_token_store_dp, self.ATTR_NAMES, batch_size=2000)
+        num_rows = manifest.state.get('num_input_rows', 0)
+        batches = self._iter_batches(num_rows, chunksize, batch_size)
+        pool = None
+        if num_workers > 1:
+            pool = multiprocessing.Pool(num_workers)
+            results = pool.imap(self._parse_batch, batches)
+        else:
+            results = map(self._parse_batch, batches)
+        try:
+            with tqdm(initial=num_rows)as pbar:
+                for parsed_rows in results:
+                    pbar.update(len(parsed_rows))
+                    num_rows += len(parsed_rows)
+                    for res in parsed_rows:
+                        if 'wrong_xml' in res.keys():
+                            self._logger.warning(f"xml is wrong: \n"
+                                                 f"pid:{res['pid']}, tid:{res['tid']},\n"
+                                                 f"xml:{res['wrong_xml']}")
+                            continue
+                        tag_token_pairs_batch.append(res['pid'], res['tid'], res['text_type'], res['year'],
+                                                     res['tag_token_pairs'], res['attrs'])
+                    if tag_token_pairs_batch.is_full():
+                        tag_token_pairs_batch.flush()
+                        manifest.commit(num_input_rows=num_rows)
+            tag_token_pairs_batch.flush()
+            manifest.commit(num_input_rows=num_rows)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
 
 if __name__ == "__main__":
     tte = TagTokenExtractor(ConfigUtils.load_config('./config.json').proj_config)
-    tte.process()
+    tte.process(num_workers=multiprocessing.cpu_count())
@@ -5,79 +5,98 @@
 # @File    : unit_tagger.py
 # @Software: PyCharm
 import os.path
+import re
+import json
+import time
 
+import numpy as np
 import pandas as pd
-import networkx as nx
 from cuspy import ConfigUtils
 
+from utils.token_store import TokenStore
+
+
+class UnitTrie:
+    """ 候选单位的前缀树, 每个候选是 CD 之后的一段 token, 只插入到它不能再延长的位置
+
+    节点的各项保存在平行的列表中, 节点 0 为根:
+        children: token id -> 子节点
+        counts: 经过该节点的候选数
+        stop_counts: 在该节点停止延长的候选数
+        firsts, first_stops: 第一个经过 / 在此停止的候选的起始位置, 为在 token store 的 tag.bin/token.bin 中的位置
+    """
+
+    def __init__(self):
+        self.children = [{}]
+        self.counts = [0]
+        self.stop_counts = [0]
+        self.firsts = [None]
+        self.first_stops = [None]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add_child(self, node: int, token: int, first: int) -> int:
+        child = self.children[node].get(token)
+        if child is None:
+            child = len(self.counts)
+            self.children[node][token] = child
+            self.children.append({})
+            self.counts.append(0)
+            self.stop_counts.append(0)
+            self.firsts.append(first)
+            self.first_stops.append(None)
+        self.counts[child] += 1
+        return child
+
+    def add_stop(self, node: int, first: int):
+        self.stop_counts[node] += 1
+        if self.first_stops[node] is None:
+            self.first_stops[node] = first
+
 
 class UnitTagger:
 
     MIN_COUNT = 10
     DEBUG_FID = 0
+    DEBUG_LEVELS = ['off', 'final', 'round']
     WRONG_TAGS = ['VBZ', 'VBD', 'VBN', 'VBP',
                   'IN', 'IN-IN', 'IN-OF', 'IN-OVER', 'IN-FOR', 'IN-WITH', 'IN-UNDER',
                   'DT-THE',
                   'TO', 'COMMA', 'STOP', 'CC', 'WRB', 'COLON']
     WRONG_WORDS = ['elsevier']
+    SQUARES = [('(', ')'), ('[', ']'), ('{', '}')]
 
     def __init__(self, config):
-        self._sent_with_cd_df = pd.read_csv(config.tag_token_pairs_fp, sep='\t', encoding='utf-8')
+        self._token_store = TokenStore(config.tag_token_store_dp)
         self._units_fp = config.units_fp
         self._filter_units_fp = config.filter_units_fp
+        self._max_unit_len = config.max_unit_len
         self.DEBUG_DP = config.debug_dp
-        if not os.path.exists(self.DEBUG_DP):
+        self._debug_level = config.unit_debug_level
+        if self._debug_level not in self.DEBUG_LEVELS:
+            raise ValueError(f"unit_debug_level should be one of {self.DEBUG_LEVELS}, but got {self._debug_level}")
+        if self._debug_level != 'off' and not os.path.exists(self.DEBUG_DP):
             os.mkdir(self.DEBUG_DP)
+        self._vocab_ids = {s: i for i, s in enumerate(self._token_store.vocab)}
+        self._numeric_cache = {}
+        self._square_cache = {}
 
     @classmethod
-    def _split_tokens_by_cd(cls, tagged_tokens):
-        tag_tokens_list = []
-        for i, (tag, token) in enumerate(tagged_tokens):
-            for ts in tag_tokens_list:
-                ts.append((tag, token))
-            if tag == 'CD':
-                tag_tokens_list.append([])
-        return tag_tokens_list
+    def _split_tokens_by_cd(cls, tags: np.ndarray, token_ends: np.ndarray, cd_id: int, max_unit_len: int,
+                            chunk_size: int = 1 << 22):
+        """ 候选单位是共享的 tag/token 数组上的窗口, 从 CD 之后开始, 到所在文本的末尾或 max_unit_len 个 token 为止
 
-    @classmethod
-    def _contain_cd(cls, tagged_tokens):
-        if len(tagged_tokens) == 0:
-            return False
-        tags, tokens = list(zip(*tagged_tokens))
-        return 'CD' in tags
-
-    def _count_unit(self):
-        unit_tag_tokens = {}
-        for _, row in self._sent_with_cd_df.iterrows():
-            tagged_tokens = eval(row.tag_token_pairs)
-            if not self._contain_cd(tagged_tokens):
-                continue
-            candidate_units_list = self._split_tokens_by_cd(tagged_tokens)
-            for candidate_units in candidate_units_list:
-                if len(candidate_units) == 0:
-                    continue
-                if candidate_units[0][1] not in unit_tag_tokens.keys():
-                    unit_tag_tokens[candidate_units[0][1]] = [candidate_units]
-                else:
-                    unit_tag_tokens[candidate_units[0][1]].append(candidate_units)
-        return unit_tag_tokens
-
-    @classmethod
-    def _create_graph(cls, unit_tokens):
-        graph = nx.DiGraph()
-        graph.add_node(0, unit='', unit_tag='', tokens=[], level=0, terminal=False)
-        i = 1
-        for unit, tag_tokens in unit_tokens.items():
-            if len(tag_tokens) < 10:
-                continue
-            graph.add_node(i, unit=unit, unit_tag=tag_tokens[0][0][0], tokens=tag_tokens, level=1, terminal=False)
-            graph.add_edge(0, i)
-            i += 1
-        return graph, i
-
-    @classmethod
-    def _is_leaf(cls, graph: nx.DiGraph, node_idx: int):
-        return len(list(graph.neighbors(node_idx))) == 0
+        :param tags: token store 中所有文本的 tag, 分块查找 CD
+        :param token_ends: 每个文本的结束位置
+        :return: 迭代每个候选单位的 (起始位置, 结束位置)
+        """
+        for chunk_start in range(0, len(tags), chunk_size):
+            cd_poses = np.flatnonzero(np.asarray(tags[chunk_start: chunk_start + chunk_size]) == cd_id) + chunk_start
+            text_ends = token_ends[np.searchsorted(token_ends, cd_poses, side='right')]
+            for cd_pos, text_end in zip(cd_poses.tolist(), text_ends.tolist()):
+                if cd_pos + 1 < text_end:
+                    yield cd_pos + 1, min(text_end, cd_pos + 1 + max_unit_len)
 
     @classmethod
     def need_right_square(cls, text, left_square, right_square):
@@ -103,104 +122,184 @@ class UnitTagger:
         else:
             return False
 
-    @classmethod
-    def _split_tokens(cls, tag_tokens_list, level):
-        unit_tokens = {}
-        for tag_tokens in tag_tokens_list:
-
-            tags, tokens = list(zip(*tag_tokens))
-            old_unit = ' '.join(tokens[:level])
-            new_unit = old_unit
-            if len(tag_tokens) < level + 1:
-                pass
-            elif tag_tokens[level][0] in cls.WRONG_TAGS:
-                pass
-            elif cls.is_numeric(tag_tokens[level][1], tag_tokens[level][0]):
-                pass
-            elif tag_tokens[level][1] == ')' and not cls.need_right_square(old_unit, '(', ')'):
-                pass
-            elif tag_tokens[level][1] == ']' and not cls.need_right_square(old_unit, '[', ']'):
-                pass
-            elif tag_tokens[level][1] == '}' and not cls.need_right_square(old_unit, '{', '}'):
-                pass
-            else:
-                new_unit = ' '.join(tokens[:level+1])
-            if new_unit not in unit_tokens.keys():
-                unit_tokens[new_unit] = [tag_tokens]
-            else:
-                unit_tokens[new_unit].append(tag_tokens)
-        return unit_tokens
+    # region ===== count units =====
+    def _is_numeric_token(self, token: int) -> bool:
+        res = self._numeric_cache.get(token)
+        if res is None:
+            res = self.is_numeric(self._token_store.vocab[token], 'CD')
+            self._numeric_cache[token] = res
+        return res
 
-    @classmethod
-    def generate_child(cls, graph: nx.DiGraph, i):
-        stop = True
-        childs = {}
-        for node_idx in graph.nodes:
-            if not cls._is_leaf(graph, node_idx):
-                continue
-            if graph.nodes[node_idx]['terminal']:
+    def _get_square_effect(self, token: int) -> [(int, int)]:
+        """ token 对 need_right_square 中 need 的作用, 对每种括号为 (a, b), 作用后 need = max(need + a, b)
+
+        """
+        effect = self._square_cache.get(token)
+        if effect is None:
+            effect = []
+            for left_square, right_square in self.SQUARES:
+                a, b = 0, 0
+                for c in self._token_store.vocab[token]:
+                    if c == left_square:
+                        a, b = a + 1, b + 1
+                    elif c == right_square:
+                        a, b = a - 1, max(b - 1, 0)
+                effect.append((a, b))
+            self._square_cache[token] = effect
+        return effect
+
+    def _insert_candidate(self, trie: UnitTrie, start: int, tags: [int], tokens: [int],
+                          cd_id: int, wrong_tag_ids: set, right_square_idxes: {int: int}):
+        """ 与逐层扩展的规则相同: 下一个 token 不存在 (或超出窗口)、tag 在 WRONG_TAGS 中、是数字或是多余的右括号时停止延长
+
+        :param start: 候选单位在 token store 中的起始位置
+        :param tags: 候选单位窗口中的 tag
+        :param tokens: 候选单位窗口中的 token
+        """
+        first = start
+        node = trie.add_child(0, tokens[0], first)
+        need = [max(a, b) for a, b in self._get_square_effect(tokens[0])]
+        for j in range(1, len(tokens)):
+            tag, token = tags[j], tokens[j]
+            if tag in wrong_tag_ids:
+                break
+            if tag == cd_id and self._is_numeric_token(token):
+                break
+            square_idx = right_square_idxes.get(token)
+            if square_idx is not None and need[square_idx] == 0:
+                break
+            node = trie.add_child(node, token, first)
+            need = [max(n + a, b) for n, (a, b) in zip(need, self._get_square_effect(token))]
+        trie.add_stop(node, first)
+
+    def _count_unit(self) -> UnitTrie:
+        """ 流式读取 token store 一遍, 把 CD 之后的候选单位插入前缀树, 不保存候选单位本身
+
+        """
+        trie = UnitTrie()
+        cd_id = self._vocab_ids.get('CD')
+        if cd_id is None:
+            return trie
+        wrong_tag_ids = {self._vocab_ids[tag] for tag in self.WRONG_TAGS if tag in self._vocab_ids}
+        right_square_idxes = {self._vocab_ids[rs]: i for i, (_, rs) in enumerate(self.SQUARES)
+                              if rs in self._vocab_ids}
+        store = self._token_store
+        token_ends = np.asarray(store.token_ends[:len(store)])
+        num_tokens = int(token_ends[-1]) if len(token_ends) > 0 else 0
+        for start, end in self._split_tokens_by_cd(store.tags[:num_tokens], token_ends, cd_id, self._max_unit_len):
+            self._insert_candidate(trie, start, store.tags[start: end].tolist(), store.tokens[start: end].tolist(),
+                                   cd_id, wrong_tag_ids, right_square_idxes)
+        return trie
+    # endregion
+
+    # region ===== induce units =====
+    def _get_unit_tag(self, first: int, level: int) -> str:
+        tags = self._token_store.tags[first: first + level].tolist()
+        return ' '.join(self._token_store.vocab[tag] for tag in tags)
+
+    def _create_tree(self, trie: UnitTrie) -> ([{}], [int]):
+        """ 展开后的树, 每个节点对应前缀树中的一个节点, 只包含候选数不少于 MIN_COUNT 的节点
+
+        :return: (树的节点列表, 待展开的节点)
+        """
+        tree = [{'unit': '', 'unit_tag': '', 'count': 0, 'level': 0, 'terminal': False,
+                 'trie_node': 0, 'children': []}]
+        for token, trie_node in trie.children[0].items():
+            if trie.counts[trie_node] < self.MIN_COUNT:
                 continue
-            node_data = graph.nodes[node_idx]
-            unit_tokens = cls._split_tokens(node_data['tokens'], node_data['level'])
-            has_child = False
-            childs[node_idx] = []
-            old_unit = node_data['unit']
-            for unit, tag_tokens in unit_tokens.items():
-                if len(tag_tokens) < cls.MIN_COUNT:
+            tree[0]['children'].append(len(tree))
+            tree.append({'unit': self._token_store.vocab[token],
+                         'unit_tag': self._get_unit_tag(trie.firsts[trie_node], 1),
+                         'count': trie.counts[trie_node], 'level': 1, 'terminal': False,
+                         'trie_node': trie_node, 'children': []})
+        leaves = tree[0]['children'] if len(tree[0]['children']) > 0 else [0]
+        return tree, leaves
+
+    def generate_child(self, trie: UnitTrie, tree: [{}], leaves: [int]) -> (bool, [int]):
+        """ 展开一层: 节点中的候选按下一个 token 分组, 不能延长的候选为一组 (终止节点),
+        组按其中第一个候选的位置排序, 保留候选数不少于 MIN_COUNT 的组
+
+        :return: (是否没有产生新节点, 新的待展开节点)
+        """
+        stop = True
+        new_leaves = []
+        for node_idx in leaves:
+            node_data = tree[node_idx]
+            trie_node = node_data['trie_node']
+            level = node_data['level']
+            groups = [(trie.firsts[child], token, child) for token, child in trie.children[trie_node].items()]
+            if trie.stop_counts[trie_node] > 0:
+                groups.append((trie.first_stops[trie_node], None, trie_node))
+            groups.sort(key=lambda x: x[0])
+            for first, token, child in groups:
+                count = trie.stop_counts[child] if token is None else trie.counts[child]
+                if node_idx == 0 or count < self.MIN_COUNT:
                     continue
+                stop = False
+                node_data['children'].append(len(tree))
+                if token is None:
+                    tree.append({'unit': node_data['unit'], 'unit_tag': self._get_unit_tag(first, level),
+                                 'count': count, 'level': level, 'terminal': True,
+                                 'trie_node': child, 'children': []})
                 else:
-                    has_child = True
-                    stop = False
-                    tags, tokens = list(zip(*tag_tokens[0]))
-                    new_level = node_data['level'] if unit == old_unit else node_data['level'] + 1
-                    new_unit_tag = ' '.join(tags[:new_level])
-                    childs[node_idx].append({'unit': unit, 'unit_tag': new_unit_tag, 'tokens': tag_tokens,
-                                             'level': new_level, 'terminal': unit == old_unit})
-            if not has_child:
-                graph.nodes[node_idx]['terminal'] = True
-        for idx, child in childs.items():
-            for c in child:
-                graph.add_node(i, **c)
-                graph.add_edge(idx, i)
-                i += 1
-        return graph, stop, i
+                    new_leaves.append(len(tree))
+                    tree.append({'unit': f"{node_data['unit']} {self._token_store.vocab[token]}",
+                                 'unit_tag': self._get_unit_tag(first, level + 1),
+                                 'count': count, 'level': level + 1, 'terminal': False,
+                                 'trie_node': child, 'children': []})
+            if len(node_data['children']) == 0:
+                node_data['terminal'] = True
+        return stop, new_leaves
 
+    # region ===== debug =====
     @classmethod
-    def _graph_to_texts(cls, graph: nx.DiGraph, node_idx: int):
-        node_data = graph.nodes[node_idx]
-        tab = '\t'*node_data['level']
-        unit = node_data['unit']
-        unit_tag = node_data['unit_tag']
-        terminal = node_data['terminal']
-        level = node_data['level']
-        count = len(node_data['tokens'])
-        yield f"{tab}{node_idx}/{level}:【{unit}】【{unit_tag}】 - {count}/{terminal}"
-        for child in graph.neighbors(node_idx):
-            for line in cls._graph_to_texts(graph, child):
-                yield line
-
-    def _graph_to_txt_fp(self, graph: nx.DiGraph):
-        txt_fp = os.path.join(self.DEBUG_DP, f"{self.DEBUG_FID}.txt")
+    def _iter_tree_records(cls, tree: [{}]):
+        """ 非递归地先序遍历树, 每个节点为一条记录
+
+        """
+        stack = [(0, None)]
+        while len(stack) > 0:
+            node_idx, parent_idx = stack.pop()
+            node_data = tree[node_idx]
+            yield {'id': node_idx, 'parent': parent_idx, 'level': node_data['level'], 'unit': node_data['unit'],
+                   'tag': node_data['unit_tag'], 'count': node_data['count'], 'terminal': node_data['terminal']}
+            stack.extend((child, node_idx) for child in reversed(node_data['children']))
+
+    def _dump_tree(self, tree: [{}]):
+        """ 把树写入 DEBUG_DP 中新编号的 jsonl 文件, 每行一个节点
+
+        """
+        jsonl_fp = os.path.join(self.DEBUG_DP, f"{self.DEBUG_FID}.jsonl")
         self.DEBUG_FID += 1
-        lines = list(self._graph_to_texts(graph, 0))
-        with open(txt_fp, 'w', encoding='utf-8')as f:
-            f.write('\n'.join(lines))
+        with open(jsonl_fp, 'w', encoding='utf-8')as f:
+            for record in self._iter_tree_records(tree):
+                f.write(json.dumps(record, ensure_ascii=False))
+                f.write('\n')
+
+    def _log_round(self, round_idx: int, tree: [{}], leaves: [int], seconds: float):
+        """ 把每一轮的节点数和用时追加到 DEBUG_DP/rounds.jsonl
+
+        """
+        with open(os.path.join(self.DEBUG_DP, 'rounds.jsonl'), 'a', encoding='utf-8')as f:
+            f.write(json.dumps({'round': round_idx, 'num_nodes': len(tree), 'num_leaves': len(leaves),
+                                'seconds': round(seconds, 6)}))
+            f.write('\n')
+    # endregion
 
     @classmethod
-    def _extract_units(cls, graph: nx.DiGraph, tsv_fp: str):
+    def _extract_units(cls, tree: [{}], tsv_fp: str):
         unit_data = {'unit': [], 'tag': [], 'count': [], 'level': []}
-        for node_idx in graph.nodes:
-            if not cls._is_leaf(graph, node_idx):
+        for node_data in tree:
+            if len(node_data['children']) > 0:
                 continue
-            node_data = graph.nodes[node_idx]
             unit_data['unit'].append(node_data['unit'])
             unit_data['tag'].append(node_data['unit_tag'])
-            unit_data['count'].append(len(node_data['tokens']))
+            unit_data['count'].append(node_data['count'])
             unit_data['level'].append(node_data['level'])
         unit_data_df = pd.DataFrame(unit_data)
         unit_data_df = unit_data_df.sort_values('count', ascending=False)
         unit_data_df.to_csv(tsv_fp, sep='\t', encoding='utf-8', index=False)
-        # return sort_unit_count
+    # endregion
 
     @classmethod
     def check_square(cls, text: str, ls: str, rs: str):
@@ -240,21 +339,81 @@ class UnitTagger:
 
         return True
 
+    @classmethod
+    def _get_square_mask(cls, units: pd.Series) -> np.ndarray:
+        """ 一次遍历所有单位的字符, 对每种括号计算与 check_square 相同的结果:
+        单位内括号的累计数 (左括号 +1, 右括号 -1) 从不小于 0, 且最后为 0
+
+        """
+        lengths = units.str.len().to_numpy(dtype=np.int64)
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        non_empty = lengths > 0
+        codes = np.frombuffer(''.join(units).encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+        mask = np.ones(len(units), dtype=bool)
+        if len(codes) == 0:
+            return mask
+        for ls, rs in cls.SQUARES:
+            cum_num = np.cumsum((codes == ord(ls)).astype(np.int64) - (codes == ord(rs)))
+            base = np.where(starts > 0, cum_num[np.maximum(starts - 1, 0)], 0)[non_empty]
+            min_num = np.minimum.reduceat(cum_num, starts[non_empty]) - base
+            last_num = cum_num[ends[non_empty] - 1] - base
+            mask[non_empty] &= (min_num >= 0) & (last_num == 0)
+        return mask
+
+    @classmethod
+    def _get_right_unit_mask(cls, unit_df: pd.DataFrame) -> np.ndarray:
+        """ 与逐行的 _is_right_unit 结果相同
+
+        """
+        units = unit_df['unit']
+        mask = (unit_df['count'] >= 100).to_numpy(dtype=bool, copy=True)
+        mask &= cls._get_square_mask(units)
+        # 有长度小于 4 的 token (包括连续空格产生的空 token)
+        mask &= units.str.contains(r'(?:^| )[^ ]{0,3}(?= |$)', regex=True).to_numpy(dtype=bool)
+        mask &= ~units.str[:1].str.isdigit().to_numpy(dtype=bool)
+        wrong_words = '|'.join(re.escape(word) for word in cls.WRONG_WORDS)
+        mask &= ~units.str.lower().str.contains(wrong_words, regex=True).to_numpy(dtype=bool)
+        wrong_tags = '|'.join(re.escape(tag) for tag in cls.WRONG_TAGS)
+        mask &= ~unit_df['tag'].str.contains(f'(?:^| )(?:{wrong_tags})(?= |$)', regex=True).to_numpy(dtype=bool)
+        return mask
+
     @classmethod
     def _filter_units(cls, unit_fp: str, filter_unit_fp: str):
-        unit_df = pd.read_csv(unit_fp, sep='\t', encoding='utf-8')
-        unit_df = unit_df.loc[unit_df.apply(cls._is_right_unit, axis=1)]
+        unit_df = pd.read_csv(unit_fp, sep='\t', encoding='utf-8', dtype={'unit': str, 'tag': str},
+                              keep_default_na=False)
+        unit_df = unit_df.loc[cls._get_right_unit_mask(unit_df)]
         unit_df.to_csv(filter_unit_fp, sep='\t', encoding='utf-8', index=False)
 
     def tag(self):
-        unit_tag_tokens = self._count_unit()
-        graph, now_i = self._create_graph(unit_tag_tokens)
+        """ unit_debug_level 为 'off' 时不写调试文件, 'final' 时只写最终的树, 'round' 时写每一轮的树;
+        不为 'off' 时在 DEBUG_DP/rounds.jsonl 中记录每一轮的节点数、待展开的节点数和用时, 第 0 轮为建立前缀树
+
+        """
+        debug = self._debug_level != 'off'
+        rounds_fp = os.path.join(self.DEBUG_DP, 'rounds.jsonl')
+        if debug and os.path.exists(rounds_fp):
+            os.remove(rounds_fp)
+        start_time = time.time()
+        trie = self._count_unit()
+        tree, leaves = self._create_tree(trie)
+        if debug:
+            self._log_round(0, tree, leaves, time.time() - start_time)
+        if self._debug_level == 'round':
+            self._dump_tree(tree)
         stop = False
-        self._graph_to_txt_fp(graph)
+        round_idx = 0
         while not stop:
-            graph, stop, now_i = self.generate_child(graph, now_i)
-            self._graph_to_txt_fp(graph)
-        self._extract_units(graph, self._units_fp)
+            round_idx += 1
+            start_time = time.time()
+            stop, leaves = self.generate_child(trie, tree, leaves)
+            if debug:
+                self._log_round(round_idx, tree, leaves, time.time() - start_time)
+            if self._debug_level == 'round':
+                self._dump_tree(tree)
+        if self._debug_level == 'final':
+            self._dump_tree(tree)
+        self._extract_units(tree, self._units_fp)
         self._filter_units(self._units_fp, self._filter_units_fp)
 
 
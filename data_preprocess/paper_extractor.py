@@ -13,7 +13,8 @@ from tqdm import tqdm
 import pandas as pd
 from cuspy import ConfigUtils
 
-from utils.tsv_utils import TSVUtils
+from utils.record_batch import RecordBatch
+from utils.stage_manifest import StageManifest
 
 
 class PaperExtractor:
@@ -52,52 +53,58 @@ class PaperExtractor:
             return default_year
         return year
 
+    @classmethod
+    def _source_df_to_columns(cls, source_df: pd.DataFrame, source_fp: str, start_pid: int):
+        num = len(source_df)
+        return {'pid': range(start_pid, start_pid + num),
+                'source_fp': source_fp,
+                'source_id': source_df.index,
+                'doi': source_df['DI'],
+                'title': source_df['TI'],
+                'abstract': source_df['AB']}
+
     @classmethod
     def wos_to_df(cls, wos_fp: str):
-        paper_df = pd.DataFrame(columns=['pid', 'source_fp', 'source_id', 'doi', 'title', 'abstract'])
         try:
             wos_df = pd.read_csv(wos_fp, sep='\t', encoding='utf-8')
         except Exception as e:
             return None
-        for idx, row in wos_df.iterrows():
-            paper_df = paper_df.append({'pid': idx,
-                                        'source_fp': wos_fp,
-                                        'source_id': idx,
-                                        'doi': row.DI,
-                                        'title': row.TI,
-                                        'abstract': row.AB}, ignore_index=True)
-        return paper_df
+        columns = cls._source_df_to_columns(wos_df, wos_fp, 0)
+        columns['pid'] = wos_df.index
+        return pd.DataFrame(columns, columns=['pid', 'source_fp', 'source_id', 'doi', 'title', 'abstract'])
 
     def process(self):
-        paper_df = pd.DataFrame(columns=['pid', 'source_fp', 'source_id', 'doi', 'title', 'abstract', 'year'])
-        pid = 0
-        tot = len(list(os.listdir(self._origin_papers_dp)))
-        if os.path.exists(self._papers_fp):
-            os.remove(self._papers_fp)
-        with tqdm(total=tot)as pbar:
-            for source_fn in os.listdir(self._origin_papers_dp):
+        """ 增量处理: 已处理且未改动的 wos 文件会被跳过, 新文件的论文追加到 papers.tsv 末尾
+
+        """
+        source_fns = sorted(os.listdir(self._origin_papers_dp))
+        source_fps = {fn: os.path.join(self._origin_papers_dp, fn) for fn in source_fns}
+        manifest = StageManifest([self._papers_fp])
+        if not manifest.resume() or any(fn not in source_fps or StageManifest.fingerprint(source_fps[fn]) != fingerprint
+                                        for fn, fingerprint in manifest.inputs.items()):
+            manifest.reset()
+        paper_batch = RecordBatch(self._papers_fp,
+                                  ['pid', 'source_fp', 'source_id', 'doi', 'title', 'abstract', 'year'],
+                                  batch_size=1000, mode='a', auto_flush=False)
+        pid = manifest.state.get('next_pid', 0)
+        with tqdm(total=len(source_fns))as pbar:
+            for source_fn in source_fns:
                 pbar.update(1)
-                source_fp = os.path.join(self._origin_papers_dp, source_fn)
+                if source_fn in manifest.inputs:
+                    continue
+                source_fp = source_fps[source_fn]
                 year = self._get_year(source_fn)
                 try:
                     source_df = pd.read_csv(source_fp, sep='\t', encoding='utf-8')
                 except Exception as e:
                     continue
-                for idx, row in source_df.iterrows():
-                    paper_df = paper_df.append({'pid': pid,
-                                                'source_fp': source_fp,
-                                                'source_id': idx,
-                                                'doi': row.DI,
-                                                'title': row.TI,
-                                                'abstract': row.AB,
-                                                'year': year}, ignore_index=True)
-                    pid += 1
-                    if len(paper_df) >= 1000:
-                        TSVUtils.df_to_tsv(paper_df, self._papers_fp, mode='a')
-                        paper_df = pd.DataFrame(columns=['pid', 'source_fp', 'source_id', 'doi', 'title', 'abstract', 'year'])
-        if len(paper_df) > 0:
-            TSVUtils.df_to_tsv(paper_df, self._papers_fp, mode='a')
-        # paper_df.to_csv(self._papers_fp, sep='\t', encoding='utf-8', index=False)
+                columns = self._source_df_to_columns(source_df, source_fp, pid)
+                columns['year'] = year
+                paper_batch.extend(columns)
+                pid += len(source_df)
+                paper_batch.flush()
+                manifest.inputs[source_fn] = StageManifest.fingerprint(source_fp)
+                manifest.commit(next_pid=pid)
 
 
 if __name__ == "__main__":
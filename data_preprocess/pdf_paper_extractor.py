@@ -6,59 +6,178 @@
 # @Software: PyCharm
 
 import os
+import json
+import shutil
+import signal
+import tempfile
 import logging
 
-import pandas as pd
 from tqdm import tqdm
 from cuspy import ConfigUtils
 
 from utils.pdf_utils import PDFUtils
+from utils.concurrent_utils import ConcurrentUtils
+from utils.record_batch import RecordBatch
+from utils.pdf_text_cache import PDFTextCache
+from utils.stage_manifest import StageManifest
 
 
 logging.basicConfig(level=logging.ERROR)
 
 
+class PDFTimeout(BaseException):
+    """ 继承 BaseException, 避免被 pdf_to_text 中的 except Exception 吞掉
+
+    """
+    pass
+
+
+def _raise_pdf_timeout(signum, frame):
+    raise PDFTimeout()
+
+
 class PDFPaperExtractor:
 
+    COLUMNS = ['pid', 'source_fp', 'source_id', 'doi', 'title', 'abstract', 'page', 'bbox', 'context']
+
     def __init__(self, config):
         self._origin_pdf_dp = config.origin_papers_dp
         self._papers_fp = config.papers_fp
+        self._pdf_cache = PDFTextCache(config.pdf_cache_dp, config.pdf_cache_max_mb)
 
     @classmethod
-    def _extract_pdf(cls, pdf_fp: str) -> [str]:
+    def _spool_pdf(cls, pdf_fp: str, spool_fp: str, cache: PDFTextCache = None) -> int:
+        """ 将 pdf 的段落逐条写入 spool_fp, 不在内存中保留整篇文档
+
+        :return: 段落数, 解析失败时为 0
+        """
+        num_paras = 0
         try:
-            texts = PDFUtils.pdf_to_text(pdf_fp)
+            with open(spool_fp, 'w', encoding='utf-8')as f:
+                for page_no, bbox, para in PDFUtils.iter_paragraphs(pdf_fp, cache):
+                    f.write(json.dumps([page_no, bbox, para]))
+                    f.write('\n')
+                    num_paras += 1
         except Exception as e:
             # raise e
             print(e)
-            return []
-        return texts
+            return 0
+        return num_paras
 
-    def process(self):
-        pdf_fns = list(os.listdir(self._origin_pdf_dp))
-        papers_df = pd.DataFrame(columns=['pid', 'source_fp', 'source_id',
-                                          'doi', 'title', 'abstract', 'contexts'])
+    @classmethod
+    def _iter_spool(cls, spool_fp: str):
+        with open(spool_fp, 'r', encoding='utf-8')as f:
+            for line in f:
+                yield json.loads(line)
+
+    @classmethod
+    def _extract_pdf_job(cls, job: (int, str, int, PDFTextCache, str)) -> (int, str, str):
+        """ 解析单个 pdf, 超过 timeout 秒则放弃 (仅在支持 SIGALRM 的系统上生效)
+
+        :param job: (n, pdf_fp, timeout, cache, spool_dp)
+        :return: (n, pdf_fp, spool_fp), 解析失败时 spool_fp 为 None
+        """
+        n, pdf_fp, timeout, cache, spool_dp = job
+        spool_fp = os.path.join(spool_dp, f"{n}.jsonl")
+        use_alarm = timeout is not None and hasattr(signal, 'SIGALRM')
+        old_handler = None
+        if use_alarm:
+            old_handler = signal.signal(signal.SIGALRM, _raise_pdf_timeout)
+            signal.alarm(timeout)
+        try:
+            num_paras = cls._spool_pdf(pdf_fp, spool_fp, cache)
+        except PDFTimeout:
+            print(f"timeout: {pdf_fp}")
+            num_paras = 0
+        finally:
+            if use_alarm:
+                signal.alarm(0)
+                signal.signal(signal.SIGALRM, old_handler if old_handler is not None else signal.SIG_DFL)
+        if num_paras == 0:
+            if os.path.exists(spool_fp):
+                os.remove(spool_fp)
+            return n, pdf_fp, None
+        return n, pdf_fp, spool_fp
+
+    def process(self, num_workers: int = 1, timeout: int = None):
+        """ 每个段落写为 papers.tsv 中的一行, 已处理且未改动的 pdf 会被跳过
+
+        :param num_workers: 进程数, 大于 1 时使用进程池, 结果按完成顺序写入 papers.tsv
+        :param timeout: 单个 pdf 的解析时间上限 (秒), None 表示不限制
+        :return: 解析失败的 pdf 数
+        解析失败、超时或使工作进程崩溃的 pdf 记录在 manifest 的 failed_pdfs 中, 未改动时继续运行会跳过
+        """
+        pdf_fns = sorted(os.listdir(self._origin_pdf_dp))
+        pdf_fps = {fn: os.path.join(self._origin_pdf_dp, fn) for fn in pdf_fns}
+        manifest = StageManifest([self._papers_fp])
+        if not manifest.resume() or any(fn not in pdf_fps or StageManifest.fingerprint(pdf_fps[fn]) != fingerprint
+                                        for fn, fingerprint in manifest.inputs.items()):
+            manifest.reset()
+        failed_pdfs = manifest.state.get('failed_pdfs', {})
+        failed_pdfs = {fn: fingerprint for fn, fingerprint in failed_pdfs.items()
+                       if fn in pdf_fps and StageManifest.fingerprint(pdf_fps[fn]) == fingerprint}
+        new_fns = [fn for fn in pdf_fns if fn not in manifest.inputs and fn not in failed_pdfs]
+        start_pid = manifest.state.get('next_pid', 0)
+        # 预留整段 pid, 中断后继续时未完成的 pdf 不会与已写入的 pid 重复
+        next_pid = start_pid + len(new_fns)
+        spool_dp = tempfile.mkdtemp(prefix='pdf_spool_', dir=os.path.dirname(os.path.abspath(self._papers_fp)))
+        jobs = [(start_pid + n, pdf_fps[pdf_fn], timeout, self._pdf_cache, spool_dp)
+                for n, pdf_fn in enumerate(new_fns)]
+        # 段落数达到 batch_size 时就写入, 不在内存中保留整篇 pdf; manifest 只在 pdf 之间提交,
+        # 中断后 resume 会把 papers.tsv 截断到上次提交的位置, 因此写入了一部分的 pdf 是安全的
+        papers_batch = RecordBatch(self._papers_fp, self.COLUMNS, batch_size=1000, mode='a', auto_flush=True)
+        num_committed = 0
+        done_fingerprints = {}
         num_err = 0
-        with tqdm(total=len(pdf_fns))as pbar:
-            pbar.set_description("Pdf paper extractor")
-            for n, pdf_fn in enumerate(pdf_fns):
-                pbar.set_postfix_str(f"err: {num_err} ; pdf: {pdf_fn}")
-                pbar.update(1)
-                pdf_fp = os.path.join(self._origin_pdf_dp, pdf_fn)
-                texts = self._extract_pdf(pdf_fp)
-                if len(texts) == 0:
-                    num_err += 1
-                    continue
-                papers_df = papers_df.append({'pid': n,
-                                              'source_fp': pdf_fp,
-                                              'source_id': n,
-                                              'doi': None,
-                                              'title': None,
-                                              'abstract': None,
-                                              'contexts': texts}, ignore_index=True)
-        papers_df.to_csv(self._papers_fp, sep='\t', encoding='utf-8', index=False)
+        if num_workers > 1:
+            results = ConcurrentUtils.imap_unordered_isolated(self._extract_pdf_job, jobs, num_workers)
+        else:
+            results = ((job, self._extract_pdf_job(job), False) for job in jobs)
+        try:
+            with tqdm(total=len(jobs))as pbar:
+                pbar.set_description("Pdf paper extractor")
+                for job, result, crashed in results:
+                    n, pdf_fp = job[0], job[1]
+                    spool_fp = None if crashed else result[2]
+                    pbar.set_postfix_str(f"err: {num_err} ; pdf: {os.path.basename(pdf_fp)}")
+                    pbar.update(1)
+                    if spool_fp is None:
+                        num_err += 1
+                        failed_pdfs[os.path.basename(pdf_fp)] = StageManifest.fingerprint(pdf_fp)
+                        papers_batch.flush()
+                        num_committed = papers_batch.num_written
+                        manifest.inputs.update(done_fingerprints)
+                        manifest.commit(next_pid=next_pid, failed_pdfs=failed_pdfs)
+                        done_fingerprints = {}
+                        continue
+                    for page_no, bbox, para in self._iter_spool(spool_fp):
+                        papers_batch.append({'pid': n,
+                                             'source_fp': pdf_fp,
+                                             'source_id': n,
+                                             'doi': None,
+                                             'title': None,
+                                             'abstract': None,
+                                             'page': page_no,
+                                             'bbox': ','.join(f"{v:.2f}" for v in bbox),
+                                             'context': para})
+                    os.remove(spool_fp)
+                    done_fingerprints[os.path.basename(pdf_fp)] = StageManifest.fingerprint(pdf_fp)
+                    if papers_batch.num_written > num_committed:
+                        papers_batch.flush()
+                        num_committed = papers_batch.num_written
+                        manifest.inputs.update(done_fingerprints)
+                        manifest.commit(next_pid=next_pid, failed_pdfs=failed_pdfs)
+                        done_fingerprints = {}
+            papers_batch.flush()
+            manifest.inputs.update(done_fingerprints)
+            manifest.commit(next_pid=next_pid, failed_pdfs=failed_pdfs)
+        finally:
+            if hasattr(results, 'close'):
+                results.close()
+            shutil.rmtree(spool_dp, ignore_errors=True)
+        return num_err
 
 
 if __name__ == "__main__":
     ppe = PDFPaperExtractor(ConfigUtils.load_config('./config.json').proj_config)
-    ppe.process()
+    ppe.process(num_workers=os.cpu_count(), timeout=600)
@@ -4,12 +4,13 @@
 # @Author  : zhangbc0315@outlook.com
 # @File    : text_extractor.py
 # @Software: PyCharm
-import os
 
 from tqdm import tqdm
 import pandas as pd
 from cuspy import ConfigUtils
 
+from utils.record_batch import RecordBatch
+from utils.stage_manifest import StageManifest
 from utils.tsv_utils import TSVUtils
 
 
@@ -19,48 +20,66 @@ class TextExtractor:
         self._papers_fp = config.papers_fp
         self._texts_fp = config.texts_fp
 
-    def process(self):
-        papers_df = pd.read_csv(self._papers_fp, sep='\t', encoding='utf-8')
-        texts_df = pd.DataFrame(columns=['tid', 'pid', 'text_type', 'text', 'year'])
-        tid = 0
-        if os.path.exists(self._texts_fp):
-            os.remove(self._texts_fp)
-        with tqdm(total=len(papers_df))as pbar:
-            for _, row in papers_df.iterrows():
-                pbar.update(1)
-                pid = row['pid']
-                title = row['title']
-                abstract = row['abstract']
-                year = row['year']
-                if not pd.isna(title) and len(title) > 0:
-                    texts_df = texts_df.append({'tid': tid,
-                                                'pid': pid,
-                                                'text_type': 'TITLE',
-                                                'text': title,
-                                                'year': year}, ignore_index=True)
-                    tid += 1
-                if not pd.isna(abstract) and len(abstract) > 0:
-                    texts_df = texts_df.append({'tid': tid,
-                                                'pid': pid,
-                                                'text_type': 'ABSTRACT',
-                                                'text': abstract,
-                                                'year': year}, ignore_index=True)
-                    tid += 1
-                if 'contexts' in row.index:
-                    for context in eval(row['contexts']):
-                        if len(context) > 0:
-                            texts_df = texts_df.append({'tid': tid,
-                                                        'pid': pid,
-                                                        'text_type': 'CONTEXT',
-                                                        'text': context,
-                                                        'year': year}, ignore_index=True)
-                            tid += 1
-                if len(texts_df) >= 2000:
-                    TSVUtils.df_to_tsv(texts_df, self._texts_fp, mode='a')
-                    texts_df = pd.DataFrame(columns=['tid', 'pid', 'text_type', 'text', 'year'])
-        if len(texts_df) > 0:
-            TSVUtils.df_to_tsv(texts_df, self._texts_fp, mode='a')
-        # texts_df.to_csv(self._texts_fp, sep='\t', encoding='utf-8', index=False)
+    def process(self, chunksize: int = 10000):
+        """ 增量处理: papers.tsv 只被追加时, 只处理新增的行
+
+        """
+        inputs = {'papers': StageManifest.input_version(self._papers_fp)}
+        manifest = StageManifest([self._texts_fp])
+        if not manifest.resume(inputs):
+            manifest.reset(inputs)
+        texts_batch = RecordBatch(self._texts_fp, ['tid', 'pid', 'text_type', 'text', 'year'],
+                                  batch_size=2000, mode='a', auto_flush=False)
+        num_rows = manifest.state.get('num_input_rows', 0)
+        tid = manifest.state.get('next_tid', 0)
+        with tqdm(initial=num_rows)as pbar:
+            for papers_df in TSVUtils.iter_chunks(self._papers_fp,
+                                                  ['pid', 'title', 'abstract', 'year', 'contexts', 'context'],
+                                                  chunksize=chunksize, skip_rows=num_rows, dtype={'context': str}):
+                has_contexts = 'contexts' in papers_df.columns
+                has_context = 'context' in papers_df.columns
+                for row in papers_df.itertuples(index=False):
+                    pbar.update(1)
+                    num_rows += 1
+                    pid = row.pid
+                    title = row.title
+                    abstract = row.abstract
+                    year = getattr(row, 'year', None)
+                    if not pd.isna(title) and len(title) > 0:
+                        texts_batch.append({'tid': tid,
+                                            'pid': pid,
+                                            'text_type': 'TITLE',
+                                            'text': title,
+                                            'year': year})
+                        tid += 1
+                    if not pd.isna(abstract) and len(abstract) > 0:
+                        texts_batch.append({'tid': tid,
+                                            'pid': pid,
+                                            'text_type': 'ABSTRACT',
+                                            'text': abstract,
+                                            'year': year})
+                        tid += 1
+                    if has_contexts:
+                        for context in eval(row.contexts):
+                            if len(context) > 0:
+                                texts_batch.append({'tid': tid,
+                                                    'pid': pid,
+                                                    'text_type': 'CONTEXT',
+                                                    'text': context,
+                                                    'year': year})
+                                tid += 1
+                    if has_context and not pd.isna(row.context) and len(row.context) > 0:
+                        texts_batch.append({'tid': tid,
+                                            'pid': pid,
+                                            'text_type': 'CONTEXT',
+                                            'text': row.context,
+                                            'year': year})
+                        tid += 1
+                    if texts_batch.is_full():
+                        texts_batch.flush()
+                        manifest.commit(num_input_rows=num_rows, next_tid=tid)
+        texts_batch.flush()
+        manifest.commit(num_input_rows=num_rows, next_tid=tid)
 
 
 if __name__ == "__main__":
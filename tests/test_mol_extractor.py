@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/29 10:05
+# @Author  : zhangbc0315@outlook.com
+# @File    : test_mol_extractor.py
+# @Software: PyCharm
+
+from data_extractor.mol_extractor import UniqueMolIndex
+from utils.record_batch import RecordBatch
+
+
+def test_unique_mol_index_resume_keeps_na_like_names(tmp_path):
+    """ 续跑时从 unique_mols.tsv 重建的索引应与写入前一致, 'NA'、'nan'、'null' 不能被读成缺失值
+
+    """
+    unique_mols_fp = str(tmp_path / 'unique_mols.tsv')
+    index = UniqueMolIndex()
+    unique_mols_batch = RecordBatch(unique_mols_fp, ['umid', 'name', 'smiles'], mode='a', auto_flush=False)
+    for name, smiles in [('NA', None), ('nan', 'C'), ('null', None), ('benzene', 'c1ccccc1'), ('None', None)]:
+        umid, is_new = index.add(name, smiles)
+        assert is_new
+        unique_mols_batch.append({'umid': umid, 'name': name, 'smiles': smiles})
+    unique_mols_batch.flush()
+
+    resumed_index = UniqueMolIndex.load(unique_mols_fp)
+    assert len(resumed_index) == len(index)
+    for name, smiles in [('NA', None), ('nan', 'C'), ('null', None), ('benzene', 'c1ccccc1'), ('None', None)]:
+        assert resumed_index.add(name, smiles) == index.add(name, smiles)
+        assert resumed_index.add(name, smiles)[1] is False
+    assert resumed_index.get('methane', 'C') == index.get('nan', 'C')
+    assert resumed_index.add('water', None) == (len(index), True)
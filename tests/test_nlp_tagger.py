@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/29 15:20
+# @Author  : zhangbc0315@outlook.com
+# @File    : test_nlp_tagger.py
+# @Software: PyCharm
+
+import random
+import threading
+import time
+import types
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import pytest
+
+from data_extractor.nlp_tagger import NLPTagger
+
+
+class StubTaggerHandler(BaseHTTPRequestHandler):
+    """ 本地的 ChemicalTagger 替身: 随机延迟后返回 <xml>text</xml>;
+    text 在 fail_once 中时第一次请求返回 500, text 在 fail_always 中时总是返回 500
+
+    """
+
+    def do_POST(self):
+        text = urllib.parse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))['text'][0]
+        server = self.server
+        with server.lock:
+            server.num_requests += 1
+            fail = text in server.fail_always or (text in server.fail_once and text not in server.failed)
+            server.failed.add(text)
+        time.sleep(random.random() * 0.002)
+        if fail:
+            self.send_response(500)
+            self.end_headers()
+            return
+        body = f"<xml>\n{text}\n</xml>".encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubTaggerClient:
+
+    def __init__(self, host: str):
+        self._host = host
+
+    def tag_text(self, text: str) -> str:
+        data = urllib.parse.urlencode({'text': text}).encode('utf-8')
+        with urllib.request.urlopen(self._host, data=data)as res:
+            return res.read().decode('utf-8')
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubTaggerHandler)
+    server.lock = threading.Lock()
+    server.num_requests = 0
+    server.fail_once, server.fail_always, server.failed = set(), set(), set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _make_tagger(tmp_path, server) -> NLPTagger:
+    config = types.SimpleNamespace(texts_fp=str(tmp_path / 'texts.tsv'),
+                                   texts_tagged_fp=str(tmp_path / 'texts_tagged.tsv'),
+                                   log_fp=str(tmp_path / 'log.txt'),
+                                   tagged_log_fp=str(tmp_path / 'tagged_log.txt'),
+                                   chemical_tagger_host=None)
+    return NLPTagger(config, tagger=StubTaggerClient(f"http://127.0.0.1:{server.server_port}/nlpj"))
+
+
+def _write_texts(fp: str, tids: range):
+    pd.DataFrame({'tid': list(tids),
+                  'pid': [tid // 3 for tid in tids],
+                  'text_type': 'ABSTRACT',
+                  'year': 2020,
+                  'text': [f"text {tid}" for tid in tids]}).to_csv(fp, sep='\t', index=False)
+
+
+def test_concurrent_tagging_keeps_input_order_and_retries(tmp_path, stub_server):
+    _write_texts(str(tmp_path / 'texts.tsv'), range(300))
+    stub_server.fail_once.update({'text 0', 'text 17', 'text 299'})
+    _make_tagger(tmp_path, stub_server).process(chunksize=50, num_workers=8, max_retries=2, backoff=0)
+
+    tagged_df = pd.read_csv(tmp_path / 'texts_tagged.tsv', sep='\t')
+    assert tagged_df['tid'].tolist() == list(range(300))
+    assert tagged_df['xml'].tolist() == [f"<xml>text {tid}</xml>" for tid in range(300)]
+    assert stub_server.num_requests == 303
+
+
+def test_resume_after_exhausted_retries(tmp_path, stub_server):
+    _write_texts(str(tmp_path / 'texts.tsv'), range(4500))
+    stub_server.fail_always.add('text 2500')
+    with pytest.raises(urllib.error.HTTPError):
+        _make_tagger(tmp_path, stub_server).process(chunksize=500, num_workers=4, max_retries=1, backoff=0)
+    assert pd.read_csv(tmp_path / 'texts_tagged.tsv', sep='\t')['tid'].tolist() == list(range(2000))
+
+    stub_server.fail_always.clear()
+    stub_server.num_requests = 0
+    _make_tagger(tmp_path, stub_server).process(chunksize=500, num_workers=4, max_retries=1, backoff=0)
+    tagged_df = pd.read_csv(tmp_path / 'texts_tagged.tsv', sep='\t')
+    assert tagged_df['tid'].tolist() == list(range(4500))
+    assert stub_server.num_requests == 2500
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/16 14:20
+# @Author  : zhangbc0315@outlook.com
+# @File    : concurrent_utils.py
+# @Software: PyCharm
+
+import time
+import logging
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+
+class ConcurrentUtils:
+
+    @classmethod
+    def ordered_imap(cls, executor: Executor, func, items, max_in_flight: int):
+        """ 并发执行 func, 按 items 的顺序返回结果, 同时最多有 max_in_flight 个任务未完成
+
+        :return: 迭代 (item, result)
+        """
+        window = deque()
+        for item in items:
+            window.append((item, executor.submit(func, item)))
+            if len(window) >= max_in_flight:
+                first_item, future = window.popleft()
+                yield first_item, future.result()
+        while len(window) > 0:
+            first_item, future = window.popleft()
+            yield first_item, future.result()
+
+    @classmethod
+    def imap_unordered_isolated(cls, func, items, num_workers: int):
+        """ 用进程池执行 func, 按完成顺序返回结果, 同时最多有 num_workers 个任务未完成
+
+        工作进程被杀死 (如 OOM 或段错误) 时进程池损坏, 当时未完成的任务会在之后逐个放在单独的进程池中重试,
+        重试时仍使进程池损坏的任务被认为是失败的, 其余任务不受影响
+        :return: 迭代 (item, result, failed), failed 为 True 时 result 为 None
+        """
+        items = iter(items)
+        suspects = []
+        in_flight = {}
+        executor = ProcessPoolExecutor(num_workers)
+        try:
+            exhausted = False
+            while True:
+                while not exhausted and len(in_flight) < num_workers:
+                    item = next(items, cls)
+                    if item is cls:
+                        exhausted = True
+                        break
+                    in_flight[executor.submit(func, item)] = item
+                if len(in_flight) == 0:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    item = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        suspects.append(item)
+                        broken = True
+                        continue
+                    yield item, result, False
+                if broken:
+                    suspects.extend(in_flight.values())
+                    cls._cancel_and_shutdown(executor, in_flight)
+                    in_flight = {}
+                    executor = ProcessPoolExecutor(num_workers)
+            for item in suspects:
+                try:
+                    result = executor.submit(func, item).result()
+                except BrokenProcessPool:
+                    logging.warning(f"worker crashed on {item}")
+                    executor.shutdown(wait=True)
+                    executor = ProcessPoolExecutor(1)
+                    yield item, None, True
+                    continue
+                yield item, result, False
+        finally:
+            cls._cancel_and_shutdown(executor, in_flight)
+
+    @classmethod
+    def _cancel_and_shutdown(cls, executor: Executor, futures):
+        """ 取消还未开始的任务后关闭 executor, 等价于 python 3.9 的 shutdown(cancel_futures=True)
+
+        """
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+    @classmethod
+    def retry(cls, func, *args, max_retries: int = 3, backoff: float = 1.0, **kwargs):
+        """ 失败时按 backoff, 2*backoff, 4*backoff ... 秒等待后重试, 超过 max_retries 次后抛出最后一个异常
+
+        """
+        for attempt in range(max_retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt == max_retries:
+                    raise
+                wait = backoff * (2 ** attempt)
+                logging.warning(f"{getattr(func, '__name__', func)} failed ({e}), retry in {wait}s")
+                time.sleep(wait)
+
+
+if __name__ == "__main__":
+    pass
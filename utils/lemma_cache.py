@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/26 14:05
+# @Author  : zhangbc0315@outlook.com
+# @File    : lemma_cache.py
+# @Software: PyCharm
+
+import os
+import json
+from collections import OrderedDict
+
+
+class LemmaCache:
+    """ 词形还原结果的 LRU 缓存, 可以保存到 json 文件, 下次运行时加载
+
+    文件内容为 [[token, pos, lemma], ...], 按最近使用的顺序排列
+    """
+
+    def __init__(self, lemmatize, fp: str = None, max_size: int = 1 << 16):
+        """
+
+        :param lemmatize: 如 WordNetLemmatizer().lemmatize, 参数为 (token, pos)
+        :param fp: 缓存文件, None 时不保存
+        :param max_size: 缓存的最大条目数, 超过时删除最久未使用的条目
+        """
+        self._lemmatize = lemmatize
+        self._fp = fp
+        self._max_size = max_size
+        self._cache = OrderedDict()
+        self.num_hits = 0
+        self.num_misses = 0
+        if fp is not None and os.path.exists(fp):
+            with open(fp, 'r', encoding='utf-8')as f:
+                for token, pos, lemma in json.load(f)[-max_size:]:
+                    self._cache[(token, pos)] = lemma
+
+    def __len__(self):
+        return len(self._cache)
+
+    def lemmatize(self, token: str, pos: str = 'n') -> str:
+        key = (token, pos)
+        lemma = self._cache.get(key)
+        if lemma is not None:
+            self._cache.move_to_end(key)
+            self.num_hits += 1
+            return lemma
+        self.num_misses += 1
+        lemma = self._lemmatize(token, pos)
+        self._cache[key] = lemma
+        if len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
+        return lemma
+
+    def save(self):
+        if self._fp is None:
+            return
+        tmp_fp = f"{self._fp}.tmp"
+        with open(tmp_fp, 'w', encoding='utf-8')as f:
+            json.dump([[token, pos, lemma] for (token, pos), lemma in self._cache.items()], f, ensure_ascii=False)
+        os.replace(tmp_fp, self._fp)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/13 9:40
+# @Author  : zhangbc0315@outlook.com
+# @File    : pdf_text_cache.py
+# @Software: PyCharm
+
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+
+class PDFTextCache:
+    """ 以 pdf 内容哈希为键的 pdf_to_text 结果缓存, 超过 max_mb 时按最近使用时间淘汰
+
+    缓存目录中的 index.log 逐行记录 "key\t大小" (写入或命中) 和 "key\t-1" (删除), 行的顺序即使用的顺序;
+    每个进程在内存中维护一份 key -> 大小 的 LRU 索引, 每次只读取 index.log 新增的行, 因此淘汰时不需要扫描目录,
+    多个进程 (如 pdf 解析的 worker) 写入同一个缓存目录时也能看到彼此的条目.
+    只在创建 PDFTextCache 时扫描一次目录, 按修改时间重写 index.log
+    """
+
+    INDEX_FN = 'index.log'
+
+    # 每个进程中 cache_dp -> [OrderedDict(key -> 大小), 总大小, 已读取的 index.log 位置], 不随对象被 pickle
+    _INDEXES = {}
+
+    def __init__(self, cache_dp: str, max_mb: int = 2048):
+        self._cache_dp = cache_dp
+        self._max_bytes = int(max_mb * 1024 * 1024)
+        if not os.path.exists(self._cache_dp):
+            os.makedirs(self._cache_dp, exist_ok=True)
+        self._rebuild_index()
+
+    @classmethod
+    def file_hash(cls, fp: str) -> str:
+        sha = hashlib.sha256()
+        with open(fp, 'rb')as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    @classmethod
+    def make_key(cls, pdf_fp: str, params: {}) -> str:
+        """
+
+        :param pdf_fp: pdf 文件
+        :param params: 影响解析结果的参数, 如 LAParams 和 parse_paragraph 的版本
+        :return:
+        """
+        params_str = json.dumps(params, sort_keys=True, default=str)
+        params_hash = hashlib.sha256(params_str.encode('utf-8')).hexdigest()[:16]
+        return f"{cls.file_hash(pdf_fp)}-{params_hash}"
+
+    def _get_fp(self, key: str) -> str:
+        return os.path.join(self._cache_dp, f"{key}.jsonl")
+
+    def try_iter_records(self, key: str):
+        """ 直接打开缓存文件, 不先判断是否存在, 避免判断之后文件被其他进程淘汰
+
+        文件被打开后即使被淘汰, 已打开的文件仍可读完
+        :return: records 的迭代器, 缓存不存在时为 None
+        """
+        try:
+            f = open(self._get_fp(key), 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(self._get_fp(key), None)
+            self._append_index([(key, os.fstat(f.fileno()).st_size)])
+        except OSError:
+            pass
+        return self._iter_lines(f)
+
+    @classmethod
+    def _iter_lines(cls, f):
+        with f:
+            for line in f:
+                yield json.loads(line)
+
+    def write_records(self, key: str, records):
+        """ 边写入缓存边返回 records, 只有 records 被完整遍历后缓存才会生效
+
+        """
+        fp = self._get_fp(key)
+        tmp_fp = f"{fp}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_fp, 'w', encoding='utf-8')as f:
+                for record in records:
+                    f.write(json.dumps(record))
+                    f.write('\n')
+                    yield record
+            os.replace(tmp_fp, fp)
+            self._append_index([(key, os.path.getsize(fp))])
+        finally:
+            if os.path.exists(tmp_fp):
+                os.remove(tmp_fp)
+        self._evict()
+
+    # region ===== index =====
+    def _get_index_fp(self) -> str:
+        return os.path.join(self._cache_dp, self.INDEX_FN)
+
+    def _rebuild_index(self):
+        entries = []
+        for entry in os.scandir(self._cache_dp):
+            if not entry.name.endswith('.jsonl'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, entry.name[:-len('.jsonl')], stat.st_size))
+        index_fp = self._get_index_fp()
+        tmp_fp = f"{index_fp}.{os.getpid()}.tmp"
+        with open(tmp_fp, 'w', encoding='utf-8')as f:
+            for _, key, size in sorted(entries):
+                f.write(f"{key}\t{size}\n")
+        os.replace(tmp_fp, index_fp)
+        self._INDEXES.pop(self._cache_dp, None)
+        self._sync_index()
+
+    def _sync_index(self) -> list:
+        """ 读取 index.log 中上次读取之后新增的完整的行
+
+        :return: [OrderedDict(key -> 大小), 总大小, 已读取的位置]
+        """
+        index = self._INDEXES.setdefault(self._cache_dp, [OrderedDict(), 0, 0])
+        sizes = index[0]
+        try:
+            with open(self._get_index_fp(), 'rb')as f:
+                f.seek(index[2])
+                data = f.read()
+        except OSError:
+            return index
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode('utf-8').splitlines():
+            key, size = line.split('\t')
+            size = int(size)
+            old_size = sizes.pop(key, None)
+            if old_size is not None:
+                index[1] -= old_size
+            if size >= 0:
+                sizes[key] = size
+                index[1] += size
+        index[2] += end
+        return index
+
+    def _append_index(self, records: [(str, int)]):
+        """ 用 O_APPEND 一次 write 追加所有行, 多个进程同时追加时行不会交错
+
+        :param records: [(key, 大小)], 大小为 -1 表示删除
+        """
+        if len(records) == 0:
+            return
+        data = ''.join(f"{key}\t{size}\n" for key, size in records).encode('utf-8')
+        fd = os.open(self._get_index_fp(), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+    # endregion
+
+    def _evict(self):
+        sizes, tot_size, _ = self._sync_index()
+        if tot_size <= self._max_bytes:
+            return
+        removed = []
+        for key, size in sizes.items():
+            if tot_size <= self._max_bytes:
+                break
+            try:
+                os.remove(self._get_fp(key))
+            except OSError:
+                pass
+            removed.append((key, -1))
+            tot_size -= size
+        self._append_index(removed)
+        self._sync_index()
+
+
+if __name__ == "__main__":
+    pass
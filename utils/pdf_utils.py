@@ -5,6 +5,8 @@
 # @File    : pdf_utils.py
 # @Software: PyCharm
 
+import re
+
 from pdfminer.pdfparser import PDFParser
 from pdfminer.pdfdocument import PDFDocument
 from pdfminer.pdfpage import PDFPage
@@ -14,64 +16,126 @@ from pdfminer.converter import PDFPageAggregator
 from pdfminer.layout import LTTextBoxHorizontal, LAParams
 # from pdfminer.pdfinterp import PDFTextExtractionNotAllowed
 
+from utils.pdf_text_cache import PDFTextCache
+
+
+class TextNormalizer:
+    """ 预编译的文本规范化: 合并以连字符结尾的断行, 替换特殊字符, 再将控制字符和非 ascii 字符替换为空格
+
+    每一步都是 C 实现的整串操作 (str.replace / str.translate / 正则替换), 复杂度与文本长度成线性,
+    不随文本中非 ascii 字符的个数增长
+    """
+
+    _ASCII_TABLE = str.maketrans({c: ' ' for c in list(range(32)) + [127]})
+    _NON_PRINTABLE_RE = re.compile('[^\x20-\x7e]')
+
+    def __init__(self, replacements: [(str, str)], hyphens: [str]):
+        """
+
+        :param replacements: 依次进行的 (原字符, 替换后的字符串)
+        :param hyphens: 行尾为这些字符时, 与下一行直接相连
+        """
+        self._replacements = list(replacements)
+        self._hyphens = tuple(hyphens)
+
+    def clean(self, text: str) -> str:
+        if text.isascii():
+            return text.translate(self._ASCII_TABLE)
+        return self._NON_PRINTABLE_RE.sub(' ', text)
+
+    def normalize_paragraph(self, text: str) -> str:
+        tail = '' if text.endswith(self._hyphens) else ' '
+        for hyphen in self._hyphens:
+            if f"{hyphen}\n" in text:
+                text = text.replace(f"{hyphen}\n", hyphen)
+        for old, new in self._replacements:
+            if old in text:
+                text = text.replace(old, new)
+        return self.clean(text) + tail
+
 
 class PDFUtils:
 
+    # parse_paragraph / clean_text 的输出发生变化时需要加 1, 使旧的缓存失效
+    PARSE_VERSION = 1
+
+    # '\u2013' 会被替换为 '-', 因此以它结尾的行也与下一行相连
+    _NORMALIZER = TextNormalizer(replacements=[('ﬂ', 'fi'),
+                                               ('\u2013', '-'),
+                                               ('\u2217', '*'),
+                                               ('\u2019', "'"),
+                                               ('\x01', 'SOH')],
+                                 hyphens=['-', '\u2013'])
+
     @classmethod
     def clean_text(cls, text: str):
-        for c in text:
-            if ord(c) >= 127 or ord(c) <= 31:
-                text = text.replace(c, ' ')
-            # if not c.isascii():
-            #     text = text.replace(c, " ")
-        return text
+        return cls._NORMALIZER.clean(text)
 
     @classmethod
     def parse_paragraph(cls, text: str):
-        text = text.replace('ﬂ', 'fi')
-        text = text.replace('\u2013', '-')
-        text = text.replace('\u2217', '*')
-        text = text.replace('\u2019', "'")
-        text = text.replace('', 'SOH')
-        text = text.replace(' ', ' ')
-        lines = text.split('\n')
-        cleaned_lines = []
-        for line in lines:
-            if line.endswith('-'):
-                cleaned_lines.append(line)
-            else:
-                cleaned_lines.append(line + ' ')
-        text = ''.join(cleaned_lines)
-        return cls.clean_text(text)
+        return cls._NORMALIZER.normalize_paragraph(text)
 
     @classmethod
-    def pdf_to_text(cls, pdf_fp: str):
-        paras = []
-        pdf = open(pdf_fp, 'rb')
-        parser = PDFParser(pdf)
-        doc = PDFDocument(parser)
-        # parser.set_document(doc)
-        # doc.set_parser(parser)
-        # doc.initialize()
-        if not doc.is_extractable:
-            raise ValueError("doc is not extractable")
+    def _get_cache_params(cls) -> {}:
+        return {'laparams': vars(LAParams()), 'parse_version': cls.PARSE_VERSION}
+
+    @classmethod
+    def pdf_to_text(cls, pdf_fp: str, cache: PDFTextCache = None):
+        return [para for _, _, para in cls.iter_paragraphs(pdf_fp, cache)]
+
+    @classmethod
+    def iter_paragraphs(cls, pdf_fp: str, cache: PDFTextCache = None):
+        """ 逐页解析 pdf
+
+        :return: 迭代 (页码, bbox, 段落), 页码从 1 开始, bbox 为 (x0, y0, x1, y1)
+        """
+        if cache is None:
+            yield from cls._iter_paragraphs(pdf_fp)
+            return
+        key = cache.make_key(pdf_fp, cls._get_cache_params())
+        records = cache.try_iter_records(key)
+        if records is not None:
+            for page_no, bbox, para in records:
+                yield page_no, tuple(bbox), para
         else:
+            yield from cache.write_records(key, cls._iter_paragraphs(pdf_fp))
+
+    @classmethod
+    def _iter_paragraphs(cls, pdf_fp: str):
+        for page_no, bbox, raw_para in cls.iter_raw_paragraphs(pdf_fp):
+            yield page_no, bbox, cls.parse_paragraph(raw_para)
+
+    @classmethod
+    def iter_raw_paragraphs(cls, pdf_fp: str):
+        """ 逐页解析 pdf, 不经过 parse_paragraph
+
+        :return: 迭代 (页码, bbox, pdfminer 输出的原始段落)
+        """
+        pdf = open(pdf_fp, 'rb')
+        try:
+            parser = PDFParser(pdf)
+            doc = PDFDocument(parser)
+            # parser.set_document(doc)
+            # doc.set_parser(parser)
+            # doc.initialize()
+            if not doc.is_extractable:
+                raise ValueError("doc is not extractable")
             rsrcmagr = PDFResourceManager()
             laparams = LAParams()
             device = PDFPageAggregator(rsrcmagr, laparams=laparams)
             interpreter = PDFPageInterpreter(rsrcmagr, device)
 
-            for page in PDFPage.create_pages(doc):
+            for page_no, page in enumerate(PDFPage.create_pages(doc), start=1):
                 interpreter.process_page(page)
                 layout = device.get_result()
                 for x in layout:
                     try:
                         if (isinstance(x, LTTextBoxHorizontal)):
-                            paras.append(cls.parse_paragraph(x.get_text()))
+                            yield page_no, tuple(x.bbox), x.get_text()
                     except Exception as e:
                         print("Failed")
-        pdf.close()
-        return paras
+        finally:
+            pdf.close()
 
 
 if __name__ == "__main__":
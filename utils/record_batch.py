@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/12 10:21
+# @Author  : zhangbc0315@outlook.com
+# @File    : record_batch.py
+# @Software: PyCharm
+
+import os
+
+import pandas as pd
+
+from utils.tsv_utils import TSVUtils
+
+
+class RecordBatch:
+    """ 按列累积记录, 达到 batch_size 后通过 TSVUtils.df_to_tsv 追加写入 tsv
+
+    """
+
+    def __init__(self, fp: str, columns: [str], batch_size: int = 1000, mode: str = 'w', auto_flush: bool = True):
+        """
+
+        :param fp: 输出的 tsv 文件
+        :param columns: 输出的列
+        :param batch_size: 每次写入的行数
+        :param mode: 'w' 会删除已有的文件, 'a' 在已有的文件后追加
+        :param auto_flush: False 时由调用者在合适的位置 (如一个输入处理完之后) 检查 is_full 并 flush
+        """
+        self._fp = fp
+        self._columns = list(columns)
+        self._batch_size = batch_size
+        self._auto_flush = auto_flush
+        self._data = {c: [] for c in self._columns}
+        self._num_buffered = 0
+        self.num_written = 0
+        if mode == 'w' and os.path.exists(self._fp):
+            os.remove(self._fp)
+
+    def __len__(self):
+        return self._num_buffered
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def append(self, record: {}):
+        for c in self._columns:
+            self._data[c].append(record.get(c))
+        self._num_buffered += 1
+        if self._auto_flush and self.is_full():
+            self.flush()
+
+    def extend(self, columns_data: {}):
+        """ 整列写入, 标量会被广播到整列
+
+        :param columns_data: {列名: 序列 或 标量}
+        """
+        num = None
+        for value in columns_data.values():
+            if not pd.api.types.is_scalar(value):
+                num = len(value)
+                break
+        if num is None or num == 0:
+            return
+        for c in self._columns:
+            value = columns_data.get(c)
+            if pd.api.types.is_scalar(value):
+                self._data[c].extend([value] * num)
+            else:
+                self._data[c].extend(list(value))
+        self._num_buffered += num
+        if self._auto_flush and self.is_full():
+            self.flush()
+
+    def is_full(self) -> bool:
+        return self._num_buffered >= self._batch_size
+
+    def flush(self):
+        if self._num_buffered == 0:
+            return
+        df = pd.DataFrame(self._data, columns=self._columns)
+        TSVUtils.df_to_tsv(df, self._fp, mode='a')
+        self.num_written += self._num_buffered
+        self._data = {c: [] for c in self._columns}
+        self._num_buffered = 0
+
+
+if __name__ == "__main__":
+    pass
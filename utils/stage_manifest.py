@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/14 15:02
+# @Author  : zhangbc0315@outlook.com
+# @File    : stage_manifest.py
+# @Software: PyCharm
+
+import os
+import json
+import uuid
+
+
+class StageManifest:
+    """ 记录一个阶段的输入版本、处理进度和输出大小, 用于增量运行和中断后继续
+
+    manifest 保存在第一个输出文件旁边: <output_fp>.manifest.json
+    generation: 输出被重新生成时更换, 只追加时保持不变, 下游据此判断能否增量处理
+    inputs: 输入的版本 (上游的 generation 或文件指纹)
+    state: 阶段自己的进度, 如已处理的输入行数、下一个 pid/tid
+    output_sizes: 上次提交时各输出文件的大小, 继续运行前会截断到该大小
+    """
+
+    def __init__(self, output_fps: [str]):
+        self._output_fps = list(output_fps)
+        self._fp = f"{self._output_fps[0]}.manifest.json"
+        data = self._load()
+        self.exists = data is not None
+        data = {} if data is None else data
+        self.generation = data.get('generation')
+        self.inputs = data.get('inputs', {})
+        self.state = data.get('state', {})
+        self._output_sizes = data.get('output_sizes', {})
+
+    def _load(self):
+        if not os.path.exists(self._fp):
+            return None
+        try:
+            with open(self._fp, 'r', encoding='utf-8')as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def _save(self):
+        data = {'generation': self.generation,
+                'inputs': self.inputs,
+                'state': self.state,
+                'output_sizes': self._output_sizes}
+        tmp_fp = f"{self._fp}.tmp"
+        with open(tmp_fp, 'w', encoding='utf-8')as f:
+            json.dump(data, f)
+        os.replace(tmp_fp, self._fp)
+
+    @classmethod
+    def fingerprint(cls, fp: str) -> str:
+        st = os.stat(fp)
+        return f"{st.st_size}-{st.st_mtime_ns}"
+
+    @classmethod
+    def input_version(cls, fp: str):
+        """ 上游有 manifest 时为其 generation, 否则为文件指纹
+
+        """
+        manifest = cls([fp])
+        if manifest.generation is not None:
+            return manifest.generation
+        if not os.path.exists(fp):
+            return None
+        return cls.fingerprint(fp)
+
+    def resume(self, inputs: {} = None) -> bool:
+        """ 检查能否在上次的输出上继续, 可以时将输出截断到上次提交时的大小
+
+        :param inputs: 需要与上次一致的输入版本
+        :return: False 表示需要 reset
+        """
+        if self.generation is None:
+            return False
+        for key, version in (inputs or {}).items():
+            if self.inputs.get(key) != version:
+                return False
+        for fp in self._output_fps:
+            size = self._output_sizes.get(os.path.basename(fp), 0)
+            if not os.path.exists(fp):
+                if size > 0:
+                    return False
+            elif size == 0:
+                os.remove(fp)
+            elif os.path.getsize(fp) < size:
+                return False
+            elif os.path.getsize(fp) > size:
+                os.truncate(fp, size)
+        return True
+
+    def reset(self, inputs: {} = None, keep_outputs: bool = False):
+        """ 开始新的 generation
+
+        :param inputs: 输入版本
+        :param keep_outputs: False 时删除已有的输出, True 时沿用已有的输出 (用于没有 manifest 的旧输出)
+        """
+        if not keep_outputs:
+            for fp in self._output_fps:
+                if os.path.exists(fp):
+                    os.remove(fp)
+        self.generation = uuid.uuid4().hex
+        self.inputs = dict(inputs or {})
+        self.state = {}
+        self.commit()
+
+    def commit(self, **state):
+        """ 在所有输出都 flush 之后调用, 记录进度和输出大小
+
+        """
+        self.state.update(state)
+        self._output_sizes = {os.path.basename(fp): os.path.getsize(fp) if os.path.exists(fp) else 0
+                              for fp in self._output_fps}
+        self._save()
+
+
+if __name__ == "__main__":
+    pass
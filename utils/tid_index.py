@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/21 15:40
+# @Author  : zhangbc0315@outlook.com
+# @File    : tid_index.py
+# @Software: PyCharm
+
+import io
+import os
+import csv
+import json
+
+import numpy as np
+
+from utils.stage_manifest import StageManifest
+from utils.tsv_utils import TSVUtils
+
+
+class TidIndex:
+    """ tsv 的 tid 列和每行起始位置的旁路索引, 用于不读取整个文件就知道有哪些 tid, 以及按 tid 随机读取一行
+
+    <tsv_fp>.tid_index.bin: int64, 每行的 tid
+    <tsv_fp>.tid_index.offsets.bin: int64, 每行在 tsv 中的起始字节位置
+    <tsv_fp>.tid_index.json: 建立索引时 tsv 的版本、已索引的字节数和行数、已索引部分的最后一段字节
+    tsv 只被追加时 (版本不变, 已索引部分的最后一段字节不变), 只扫描新增的部分
+    """
+
+    TAIL_SIZE = 64
+    FLUSH_ROWS = 100000
+
+    def __init__(self, tsv_fp: str):
+        self._tsv_fp = tsv_fp
+        self._bin_fp = f"{tsv_fp}.tid_index.bin"
+        self._offsets_fp = f"{tsv_fp}.tid_index.offsets.bin"
+        self._meta_fp = f"{tsv_fp}.tid_index.json"
+        self._columns = []
+        self._size = 0
+        self._is_sorted = None
+        self._tid_to_row = None
+        self.tids = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def load(cls, tsv_fp: str):
+        """ 加载索引, 索引不存在或过期时建立或补全
+
+        """
+        index = cls(tsv_fp)
+        index._update()
+        return index
+
+    def __len__(self):
+        return len(self.tids)
+
+    def max_tid(self) -> int:
+        return int(self.tids.max()) if len(self.tids) > 0 else -1
+
+    def tid_set(self) -> set:
+        return set(self.tids.tolist())
+
+    def is_sorted(self) -> bool:
+        """ tid 是否非递减, 是时可以与其他按 tid 排序的文件归并
+
+        """
+        if self._is_sorted is None:
+            self._is_sorted = bool(np.all(self.tids[1:] >= self.tids[:-1]))
+        return self._is_sorted
+
+    # region ===== build =====
+    def _read_tail(self, size: int) -> str:
+        with open(self._tsv_fp, 'rb')as f:
+            f.seek(max(0, size - self.TAIL_SIZE))
+            return f.read(min(size, self.TAIL_SIZE)).hex()
+
+    def _load_meta(self):
+        if not all(os.path.exists(fp) for fp in [self._meta_fp, self._bin_fp, self._offsets_fp]):
+            return None
+        try:
+            with open(self._meta_fp, 'r', encoding='utf-8')as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def _save_meta(self, version, size: int, num_rows: int):
+        tmp_fp = f"{self._meta_fp}.tmp"
+        with open(tmp_fp, 'w', encoding='utf-8')as f:
+            json.dump({'version': version, 'size': size, 'num_rows': num_rows, 'tail': self._read_tail(size)}, f)
+        os.replace(tmp_fp, self._meta_fp)
+
+    def _is_prefix(self, meta: {}, version, size: int) -> bool:
+        return meta is not None \
+            and meta['version'] == version \
+            and meta['size'] <= size \
+            and os.path.getsize(self._bin_fp) >= meta['num_rows'] * 8 \
+            and os.path.getsize(self._offsets_fp) >= meta['num_rows'] * 8 \
+            and self._read_tail(meta['size']) == meta['tail']
+
+    def _iter_rows(self, start: int, tid_col: int):
+        """ 从字节位置 start (行首, 0 表示从表头之后) 开始扫描, 引号内的换行不算行尾, 末尾不完整的行被忽略
+
+        :return: 迭代 (tid, 行起始位置, 行结束位置)
+        """
+        with open(self._tsv_fp, 'rb')as f:
+            if start == 0:
+                start = len(f.readline())
+            else:
+                f.seek(start)
+            pos = start
+            row_start = None
+            first_line = None
+            num_quotes = 0
+            for line in f:
+                if row_start is None:
+                    if len(line.strip()) == 0:
+                        pos += len(line)
+                        continue
+                    row_start = pos
+                    first_line = line
+                pos += len(line)
+                num_quotes += line.count(b'"')
+                if num_quotes % 2 == 1 or not line.endswith(b'\n'):
+                    continue
+                try:
+                    tid = int(first_line.split(b'\t', tid_col + 1)[tid_col])
+                except ValueError:
+                    tid = -1
+                yield tid, row_start, pos
+                row_start = None
+                num_quotes = 0
+
+    def _update(self):
+        if not os.path.exists(self._tsv_fp):
+            return
+        self._columns = TSVUtils.get_columns(self._tsv_fp)
+        version = StageManifest.input_version(self._tsv_fp)
+        size = os.path.getsize(self._tsv_fp)
+        meta = self._load_meta()
+        if self._is_prefix(meta, version, size):
+            start, num_rows = meta['size'], meta['num_rows']
+            os.truncate(self._bin_fp, num_rows * 8)
+            os.truncate(self._offsets_fp, num_rows * 8)
+        else:
+            start, num_rows = 0, 0
+            open(self._bin_fp, 'wb').close()
+            open(self._offsets_fp, 'wb').close()
+        end = start
+        if start < size or meta is None:
+            tids, offsets = [], []
+            with open(self._bin_fp, 'ab')as bin_f, open(self._offsets_fp, 'ab')as offsets_f:
+                for tid, row_start, end in self._iter_rows(start, self._columns.index('tid')):
+                    tids.append(tid)
+                    offsets.append(row_start)
+                    if len(tids) >= self.FLUSH_ROWS:
+                        bin_f.write(np.asarray(tids, dtype=np.int64).tobytes())
+                        offsets_f.write(np.asarray(offsets, dtype=np.int64).tobytes())
+                        num_rows += len(tids)
+                        tids, offsets = [], []
+                bin_f.write(np.asarray(tids, dtype=np.int64).tobytes())
+                offsets_f.write(np.asarray(offsets, dtype=np.int64).tobytes())
+                num_rows += len(tids)
+            end = max(end, start)
+            self._save_meta(version, end, num_rows)
+        self._size = end
+        if num_rows > 0:
+            self.tids = np.memmap(self._bin_fp, dtype=np.int64, mode='r', shape=(num_rows,))
+            self.offsets = np.memmap(self._offsets_fp, dtype=np.int64, mode='r', shape=(num_rows,))
+    # endregion
+
+    # region ===== random access =====
+    def locate(self, tid: int):
+        """
+
+        :return: tid 第一次出现的行号, 不存在时为 None
+        """
+        if len(self.tids) == 0:
+            return None
+        if self.is_sorted():
+            i = int(np.searchsorted(self.tids, tid, side='left'))
+            return i if i < len(self.tids) and self.tids[i] == tid else None
+        if self._tid_to_row is None:
+            n = len(self.tids)
+            self._tid_to_row = dict(zip(self.tids[::-1].tolist(), range(n - 1, -1, -1)))
+        return self._tid_to_row.get(tid)
+
+    def read_row(self, i: int) -> {str: str}:
+        """ 读取第 i 行, 值为 tsv 中的字符串, 缺失值为空字符串
+
+        """
+        start = int(self.offsets[i])
+        end = int(self.offsets[i + 1]) if i + 1 < len(self.offsets) else self._size
+        with open(self._tsv_fp, 'rb')as f:
+            f.seek(start)
+            data = f.read(end - start).decode('utf-8')
+        values = next(csv.reader(io.StringIO(data, newline=''), delimiter='\t'))
+        return dict(zip(self._columns, values))
+
+    def get_row(self, tid: int):
+        i = self.locate(tid)
+        return None if i is None else self.read_row(i)
+    # endregion
+
+
+if __name__ == "__main__":
+    pass
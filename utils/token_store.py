@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/21 10:12
+# @Author  : zhangbc0315@outlook.com
+# @File    : token_store.py
+# @Software: PyCharm
+
+import os
+import json
+from collections import namedtuple
+
+import numpy as np
+
+
+TaggedText = namedtuple('TaggedText', ['pid', 'tid', 'text_type', 'year', 'tag_token_pairs', 'attr'])
+
+
+class TokenStore:
+    """ 以二进制列保存每个文本的 (tag, token) 和属性, 读取时用 np.memmap, 不复制数据
+
+    目录中的文件:
+        vocab.jsonl: tag、token、text_type 和属性值共用的字符串表, 每行一个 json 字符串, 行号即 id
+        pid.bin, tid.bin: int64, 每个文本一个值
+        year.bin: int32, 缺失时为 -1
+        text_type.bin: int32, vocab id
+        tag.bin, token.bin: int32, vocab id, 所有文本的 token 依次拼接
+        token_end.bin: int64, 每个文本的最后一个 token 在 tag.bin/token.bin 中的结束位置
+        attr_{name}.bin, attr_{name}_end.bin: 属性值 (vocab id) 及每个文本的结束位置
+        meta.json: 属性名
+    所有 .bin 文件和 vocab.jsonl 只追加, 因此可以由 StageManifest 截断到上次提交的位置
+    """
+
+    VERSION_FN = 'pid.bin'
+
+    def __init__(self, dp: str):
+        self._dp = dp
+        self.attr_names = self.load_meta(dp).get('attr_names', [])
+        self.vocab = self.load_vocab(dp)
+        self.pids = self._memmap('pid.bin', np.int64)
+        self.tids = self._memmap('tid.bin', np.int64)
+        self.years = self._memmap('year.bin', np.int32)
+        self.text_types = self._memmap('text_type.bin', np.int32)
+        self.tags = self._memmap('tag.bin', np.int32)
+        self.tokens = self._memmap('token.bin', np.int32)
+        self.token_ends = self._memmap('token_end.bin', np.int64)
+        self._attrs = {name: (self._memmap(f'attr_{name}.bin', np.int32),
+                              self._memmap(f'attr_{name}_end.bin', np.int64))
+                       for name in self.attr_names}
+        self._num_texts = min(len(self.pids), len(self.token_ends))
+
+    # region ===== files =====
+    @classmethod
+    def get_fps(cls, dp: str, attr_names: [str]) -> [str]:
+        """ 所有只追加的文件, 第一个文件旁边保存 StageManifest
+
+        """
+        fns = [cls.VERSION_FN, 'tid.bin', 'year.bin', 'text_type.bin', 'tag.bin', 'token.bin', 'token_end.bin']
+        for name in attr_names:
+            fns.extend([f'attr_{name}.bin', f'attr_{name}_end.bin'])
+        fns.append('vocab.jsonl')
+        return [os.path.join(dp, fn) for fn in fns]
+
+    @classmethod
+    def version_fp(cls, dp: str) -> str:
+        """ 下游用 StageManifest.input_version(TokenStore.version_fp(dp)) 判断 token store 的版本
+
+        """
+        return os.path.join(dp, cls.VERSION_FN)
+
+    @classmethod
+    def load_meta(cls, dp: str) -> {}:
+        meta_fp = os.path.join(dp, 'meta.json')
+        if not os.path.exists(meta_fp):
+            return {}
+        with open(meta_fp, 'r', encoding='utf-8')as f:
+            return json.load(f)
+
+    @classmethod
+    def load_vocab(cls, dp: str) -> [str]:
+        vocab_fp = os.path.join(dp, 'vocab.jsonl')
+        if not os.path.exists(vocab_fp):
+            return []
+        with open(vocab_fp, 'r', encoding='utf-8')as f:
+            return [json.loads(line) for line in f]
+
+    def _memmap(self, fn: str, dtype):
+        fp = os.path.join(self._dp, fn)
+        if not os.path.exists(fp) or os.path.getsize(fp) < np.dtype(dtype).itemsize:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(fp, dtype=dtype, mode='r')
+    # endregion
+
+    def __len__(self):
+        return self._num_texts
+
+    def token_range(self, i: int) -> (int, int):
+        start = int(self.token_ends[i - 1]) if i > 0 else 0
+        return start, int(self.token_ends[i])
+
+    def get_tag_token_pairs(self, i: int) -> [(str, str)]:
+        start, end = self.token_range(i)
+        vocab = self.vocab
+        return [(vocab[tag], vocab[token])
+                for tag, token in zip(self.tags[start: end].tolist(), self.tokens[start: end].tolist())]
+
+    def get_attr(self, i: int) -> {str: [str]}:
+        attr = {}
+        for name, (values, ends) in self._attrs.items():
+            start = int(ends[i - 1]) if i > 0 else 0
+            attr[name] = [self.vocab[v] for v in values[start: int(ends[i])].tolist()]
+        return attr
+
+    def get_text(self, i: int) -> TaggedText:
+        year = int(self.years[i])
+        return TaggedText(pid=int(self.pids[i]),
+                          tid=int(self.tids[i]),
+                          text_type=self.vocab[int(self.text_types[i])],
+                          year=year if year >= 0 else None,
+                          tag_token_pairs=self.get_tag_token_pairs(i),
+                          attr=self.get_attr(i))
+
+    def iter_texts(self, start: int = 0):
+        for i in range(start, len(self)):
+            yield self.get_text(i)
+
+    def iter_tag_token_pairs(self, start: int = 0):
+        for i in range(start, len(self)):
+            yield self.get_tag_token_pairs(i)
+
+
+class TokenStoreWriter:
+    """ 累积文本的 (tag, token) 和属性, 达到 batch_size 后追加写入 TokenStore 的各个文件
+
+    """
+
+    def __init__(self, dp: str, attr_names: [str], batch_size: int = 2000):
+        """ 需要在 StageManifest.resume/reset 之后创建, 以便从截断后的文件继续
+
+        """
+        if not os.path.exists(dp):
+            os.makedirs(dp)
+        self._dp = dp
+        self._attr_names = list(attr_names)
+        self._batch_size = batch_size
+        with open(os.path.join(dp, 'meta.json'), 'w', encoding='utf-8')as f:
+            json.dump({'attr_names': self._attr_names}, f)
+        self._vocab = {s: i for i, s in enumerate(TokenStore.load_vocab(dp))}
+        self._num_tokens = self._get_num_items('tag.bin', np.int32)
+        self._num_attr_values = {name: self._get_num_items(f'attr_{name}.bin', np.int32) for name in self._attr_names}
+        self._clear()
+
+    def _get_num_items(self, fn: str, dtype) -> int:
+        fp = os.path.join(self._dp, fn)
+        return os.path.getsize(fp) // np.dtype(dtype).itemsize if os.path.exists(fp) else 0
+
+    def _clear(self):
+        self._columns = {fn: [] for fn in ['pid.bin', 'tid.bin', 'year.bin', 'text_type.bin',
+                                           'tag.bin', 'token.bin', 'token_end.bin']}
+        for name in self._attr_names:
+            self._columns[f'attr_{name}.bin'] = []
+            self._columns[f'attr_{name}_end.bin'] = []
+        self._new_vocab = []
+        self._num_buffered = 0
+
+    def __len__(self):
+        return self._num_buffered
+
+    def _intern(self, s) -> int:
+        s = '' if s is None else str(s)
+        idx = self._vocab.get(s)
+        if idx is None:
+            idx = len(self._vocab)
+            self._vocab[s] = idx
+            self._new_vocab.append(s)
+        return idx
+
+    def append(self, pid: int, tid: int, text_type: str, year, tag_token_pairs: [(str, str)], attr: {str: []}):
+        self._columns['pid.bin'].append(pid)
+        self._columns['tid.bin'].append(tid)
+        self._columns['year.bin'].append(-1 if year is None else int(year))
+        self._columns['text_type.bin'].append(self._intern(text_type))
+        for tag, token in tag_token_pairs:
+            self._columns['tag.bin'].append(self._intern(tag))
+            self._columns['token.bin'].append(self._intern(token))
+        self._num_tokens += len(tag_token_pairs)
+        self._columns['token_end.bin'].append(self._num_tokens)
+        for name in self._attr_names:
+            values = attr.get(name, [])
+            self._columns[f'attr_{name}.bin'].extend(self._intern(v) for v in values)
+            self._num_attr_values[name] += len(values)
+            self._columns[f'attr_{name}_end.bin'].append(self._num_attr_values[name])
+        self._num_buffered += 1
+
+    def is_full(self) -> bool:
+        return self._num_buffered >= self._batch_size
+
+    def flush(self):
+        if self._num_buffered == 0:
+            return
+        for fn, values in self._columns.items():
+            dtype = np.int64 if fn in ['pid.bin', 'tid.bin'] or fn.endswith('end.bin') else np.int32
+            with open(os.path.join(self._dp, fn), 'ab')as f:
+                f.write(np.asarray(values, dtype=dtype).tobytes())
+        with open(os.path.join(self._dp, 'vocab.jsonl'), 'a', encoding='utf-8')as f:
+            f.writelines(f"{json.dumps(s, ensure_ascii=False)}\n" for s in self._new_vocab)
+        self._clear()
+
+
+if __name__ == "__main__":
+    pass
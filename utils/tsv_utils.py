@@ -19,6 +19,37 @@ class TSVUtils:
         else:
             df.to_csv(fp, sep='\t', encoding='utf-8', index=False, header=False, mode='a')
 
+    @classmethod
+    def get_columns(cls, fp: str) -> [str]:
+        return list(pd.read_csv(fp, sep='\t', encoding='utf-8', nrows=0).columns)
+
+    @classmethod
+    def iter_chunks(cls, fp: str, columns: [str] = None, chunksize: int = 10000, skip_rows: int = 0,
+                    dtype: {} = None):
+        """ 分块读取 tsv, 只解析 columns 中的列
+
+        :param columns: 需要的列, None 时读取所有列; 不存在的列会被忽略
+        :param skip_rows: 跳过表头之后的前 skip_rows 行
+        """
+        usecols = None
+        if columns is not None:
+            existing_columns = set(cls.get_columns(fp))
+            usecols = [c for c in columns if c in existing_columns]
+        skiprows = (lambda i: 0 < i <= skip_rows) if skip_rows > 0 else None
+        for df in pd.read_csv(fp, sep='\t', encoding='utf-8', usecols=usecols, dtype=dtype,
+                              skiprows=skiprows, chunksize=chunksize):
+            yield df
+
+    @classmethod
+    def iter_rows(cls, fp: str, columns: [str] = None, chunksize: int = 10000, skip_rows: int = 0,
+                  dtype: {} = None):
+        """ 逐行迭代 iter_chunks 的结果, 每行为 namedtuple
+
+        """
+        for df in cls.iter_chunks(fp, columns, chunksize, skip_rows, dtype):
+            for row in df.itertuples(index=False):
+                yield row
+
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2023/6/25 9:36
+# @Author  : zhangbc0315@outlook.com
+# @File    : vector_index.py
+# @Software: PyCharm
+
+import os
+import json
+
+import numpy as np
+
+from utils.stage_manifest import StageManifest
+
+
+class VectorIndex:
+    """ 词向量的持久化索引, 保存在 <words_vec_fp>.index 目录中, 加载时用 mmap 读取
+
+    目录中的文件:
+        words.json: 词表, 序号即向量所在的行
+        vectors.npy: float32, 归一化后的向量, 长度为 0 的向量保持为 0
+        centroids.npy, list_offsets.npy, list_rows.npy: IVF 近似搜索用的聚类中心、每个聚类的行在 list_rows 中的范围
+        meta.json: 维度、聚类数和 words_vec 的指纹
+    search 的 mode='exact' 为分块的暴力矩阵搜索; mode='ivf' 只在与查询最接近的 nprobe 个聚类中搜索
+    """
+
+    def __init__(self, dp: str):
+        self._dp = dp
+        with open(os.path.join(dp, 'meta.json'), 'r', encoding='utf-8')as f:
+            self.meta = json.load(f)
+        with open(os.path.join(dp, 'words.json'), 'r', encoding='utf-8')as f:
+            self.words = json.load(f)
+        self._word_to_row = {w: i for i, w in enumerate(self.words)}
+        self.vectors = np.load(os.path.join(dp, 'vectors.npy'), mmap_mode='r')
+        self.centroids = np.load(os.path.join(dp, 'centroids.npy'), mmap_mode='r')
+        self.list_offsets = np.load(os.path.join(dp, 'list_offsets.npy'), mmap_mode='r')
+        self.list_rows = np.load(os.path.join(dp, 'list_rows.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word: str):
+        return word in self._word_to_row
+
+    # region ===== build =====
+    @classmethod
+    def get_index_dp(cls, words_vec_fp: str) -> str:
+        return f"{words_vec_fp}.index"
+
+    @classmethod
+    def _load_words_vec(cls, words_vec_fp: str) -> ([str], np.ndarray):
+        """ words_vec 为 gensim 保存的 Word2Vec 模型或 KeyedVectors
+
+        """
+        from gensim.models import Word2Vec, KeyedVectors
+        try:
+            kv = Word2Vec.load(words_vec_fp).wv
+        except Exception:
+            kv = KeyedVectors.load(words_vec_fp)
+        words = list(kv.index_to_key) if hasattr(kv, 'index_to_key') else list(kv.index2word)
+        return words, np.asarray(kv.vectors)
+
+    @classmethod
+    def _normalize(cls, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    @classmethod
+    def _assign(cls, vectors: np.ndarray, centroids: np.ndarray, chunk_rows: int = 65536) -> np.ndarray:
+        assign = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), chunk_rows):
+            assign[start: start + chunk_rows] = np.argmax(vectors[start: start + chunk_rows] @ centroids.T, axis=1)
+        return assign
+
+    @classmethod
+    def _kmeans(cls, vectors: np.ndarray, num_lists: int, num_iters: int, seed: int) -> (np.ndarray, np.ndarray):
+        """ 球面 k-means, 没有成员的聚类保留上一轮的中心
+
+        """
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(len(vectors), num_lists, replace=False)].copy()
+        assign = cls._assign(vectors, centroids)
+        for _ in range(num_iters):
+            sums = np.stack([np.bincount(assign, weights=vectors[:, d], minlength=num_lists)
+                             for d in range(vectors.shape[1])], axis=1)
+            non_empty = np.bincount(assign, minlength=num_lists) > 0
+            centroids[non_empty] = cls._normalize(sums[non_empty])
+            new_assign = cls._assign(vectors, centroids)
+            if np.array_equal(new_assign, assign):
+                break
+            assign = new_assign
+        return centroids, assign
+
+    @classmethod
+    def build(cls, words: [str], vectors: np.ndarray, dp: str, num_lists: int = None, num_iters: int = 10,
+              seed: int = 0, source: str = None):
+        """
+
+        :param num_lists: IVF 的聚类数, 默认为词数的平方根
+        :param source: words_vec 的指纹, 用于判断索引是否过期
+        """
+        if not os.path.exists(dp):
+            os.makedirs(dp)
+        vectors = cls._normalize(vectors)
+        num_lists = num_lists or max(1, int(np.sqrt(len(vectors))))
+        num_lists = min(num_lists, len(vectors))
+        if num_lists > 0:
+            centroids, assign = cls._kmeans(vectors, num_lists, num_iters, seed)
+        else:
+            centroids, assign = np.zeros((0, vectors.shape[1]), dtype=np.float32), np.zeros(0, dtype=np.int64)
+        list_rows = np.argsort(assign, kind='stable')
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=num_lists))])
+        np.save(os.path.join(dp, 'vectors.npy'), vectors)
+        np.save(os.path.join(dp, 'centroids.npy'), centroids)
+        np.save(os.path.join(dp, 'list_offsets.npy'), list_offsets.astype(np.int64))
+        np.save(os.path.join(dp, 'list_rows.npy'), list_rows.astype(np.int64))
+        with open(os.path.join(dp, 'words.json'), 'w', encoding='utf-8')as f:
+            json.dump(list(words), f, ensure_ascii=False)
+        with open(os.path.join(dp, 'meta.json'), 'w', encoding='utf-8')as f:
+            json.dump({'dim': int(vectors.shape[1]), 'num_lists': int(num_lists), 'source': source}, f)
+        return cls(dp)
+
+    @classmethod
+    def load_or_build(cls, words_vec_fp: str, num_lists: int = None):
+        """ 索引不存在或 words_vec 已改变时重新建立
+
+        """
+        dp = cls.get_index_dp(words_vec_fp)
+        source = StageManifest.fingerprint(words_vec_fp)
+        meta_fp = os.path.join(dp, 'meta.json')
+        if os.path.exists(meta_fp):
+            with open(meta_fp, 'r', encoding='utf-8')as f:
+                if json.load(f).get('source') == source:
+                    return cls(dp)
+        words, vectors = cls._load_words_vec(words_vec_fp)
+        return cls.build(words, vectors, dp, num_lists=num_lists, source=source)
+    # endregion
+
+    # region ===== query =====
+    def get_vec(self, word: str):
+        """
+
+        :return: 归一化的向量, 词不存在时为 None
+        """
+        row = self._word_to_row.get(word)
+        return None if row is None else np.asarray(self.vectors[row])
+
+    def get_vecs(self, words: [str]) -> [np.ndarray]:
+        return [self.get_vec(w) for w in words]
+
+    @classmethod
+    def _top_k(cls, scores: np.ndarray, rows: np.ndarray, k: int) -> ([int], [float]):
+        if len(scores) > k:
+            part = np.argpartition(-scores, k - 1)[:k]
+        else:
+            part = np.arange(len(scores))
+        order = part[np.argsort(-scores[part], kind='stable')]
+        return rows[order].tolist(), scores[order].tolist()
+
+    def _search_exact(self, queries: np.ndarray, k: int, chunk_rows: int):
+        best_rows = [np.zeros(0, dtype=np.int64) for _ in queries]
+        best_scores = [np.zeros(0, dtype=np.float32) for _ in queries]
+        for start in range(0, len(self.vectors), chunk_rows):
+            chunk_scores = queries @ np.asarray(self.vectors[start: start + chunk_rows]).T
+            rows = np.arange(start, start + chunk_scores.shape[1])
+            for i in range(len(queries)):
+                merged_rows, merged_scores = self._top_k(np.concatenate([best_scores[i], chunk_scores[i]]),
+                                                         np.concatenate([best_rows[i], rows]), k)
+                best_rows[i], best_scores[i] = np.asarray(merged_rows), np.asarray(merged_scores)
+        return [(rows.tolist(), scores.tolist()) for rows, scores in zip(best_rows, best_scores)]
+
+    def _search_ivf(self, queries: np.ndarray, k: int, nprobe: int):
+        results = []
+        nprobe = min(nprobe, len(self.centroids))
+        centroid_scores = queries @ np.asarray(self.centroids).T
+        for query, scores in zip(queries, centroid_scores):
+            lists = np.argpartition(-scores, nprobe - 1)[:nprobe]
+            rows = np.concatenate([self.list_rows[self.list_offsets[j]: self.list_offsets[j + 1]] for j in lists])
+            results.append(self._top_k(np.asarray(self.vectors[rows]) @ query, rows, k))
+        return results
+
+    def search(self, queries: np.ndarray, k: int = 10, mode: str = 'exact', nprobe: int = 8,
+               chunk_rows: int = 65536) -> [([int], [float])]:
+        """ 按余弦相似度从大到小搜索最接近的 k 个词
+
+        :param queries: 一个或多个查询向量
+        :param mode: 'exact' 或 'ivf'
+        :param nprobe: ivf 模式下搜索的聚类数, 越大越准确, 大于聚类数时等于聚类数
+        :return: 每个查询的 (行号列表, 余弦相似度列表)
+        """
+        if mode not in ['exact', 'ivf']:
+            raise ValueError(f"mode should be 'exact' or 'ivf', but got {mode}")
+        if mode == 'ivf' and nprobe < 1:
+            raise ValueError(f"nprobe should be at least 1, but got {nprobe}")
+        queries = self._normalize(np.atleast_2d(queries))
+        if len(self.vectors) == 0 or k <= 0:
+            return [([], []) for _ in queries]
+        if mode == 'ivf':
+            return self._search_ivf(queries, k, nprobe)
+        return self._search_exact(queries, k, chunk_rows)
+
+    def most_similar(self, word: str, k: int = 10, mode: str = 'exact', nprobe: int = 8) -> [(str, float)]:
+        """ 与 word 最接近的 k 个词, 不包含 word 本身, 用于扩展同义词
+
+        """
+        vec = self.get_vec(word)
+        if vec is None:
+            return []
+        rows, scores = self.search(vec, k + 1, mode, nprobe)[0]
+        return [(self.words[r], s) for r, s in zip(rows, scores) if self.words[r] != word][:k]
+    # endregion
+
+
+if __name__ == "__main__":
+    pass